@@ -0,0 +1,57 @@
+import numpy as np
+
+METHODS = ('ALS',)
+MAX_SOLVED_WIDTH = 32  # points, wider backgrounds are estimated on a coarser grid
+
+
+def als_baseline(ints, width=100, asymmetry=0.01, iterations=10):
+    # Asymmetric least squares (Eilers & Boelens): a smooth curve that points above it pull on only weakly.
+    # Each iteration solves (W + lam D'D) z = W y, a symmetric pentadiagonal system, by a banded Cholesky
+    # factorization, so time and memory are linear in the number of points.
+    # width - the shortest feature of the background, in points (lam = width^4); asymmetry - weight of the points
+    # above the baseline, those below get 1 - asymmetry; stops early when the weights no longer change
+    y = np.asarray(ints, dtype=np.float64)
+    step = int(width // MAX_SOLVED_WIDTH) + 1
+    if step > 1:  # lam = width^4 of a wide background would make the system numerically singular, so it is
+        # solved on block means of step points (a smooth curve loses nothing) and interpolated back
+        n_blocks = y.size // step
+        if n_blocks >= 3:
+            coarse = y[:n_blocks * step].reshape(n_blocks, step).mean(axis=1)
+            if n_blocks * step < y.size:
+                coarse = np.append(coarse, y[n_blocks * step:].mean())
+            centres = np.arange(coarse.size) * step + (step - 1) / 2
+            centres[-1] = min(centres[-1], (n_blocks * step + y.size - 1) / 2)
+            z = als_baseline(coarse, width / step, asymmetry, iterations)
+            return np.interp(np.arange(y.size), centres, z)
+    from scipy.linalg import solveh_banded  # imported on first use, like the other scipy modules
+    n = y.size
+    if n < 3:
+        return y.copy()
+    lam = float(width)**4
+    penalty = np.zeros((3, n))  # lam D'D in the upper banded form of solveh_banded, D - second differences
+    penalty[0, 2:] = lam
+    penalty[1, 1:] = -4 * lam
+    penalty[1, 1] = penalty[1, -1] = -2 * lam
+    penalty[2] = 6 * lam
+    penalty[2, 0] = penalty[2, -1] = lam
+    penalty[2, 1] = penalty[2, -2] = 5 * lam
+    if n == 3:
+        penalty[2, 1] = 4 * lam
+    w = np.ones(n)
+    z = y
+    bands = np.empty_like(penalty)
+    for _ in range(iterations):
+        bands[:] = penalty
+        bands[2] += w
+        z = solveh_banded(bands, w * y, overwrite_ab=True, check_finite=False)
+        new_w = np.where(y > z, asymmetry, 1 - asymmetry)
+        if np.array_equal(new_w, w):
+            break
+        w = new_w
+    return z
+
+
+def estimate_baseline(ints, method='ALS', **options):
+    if method == 'ALS':
+        return als_baseline(ints, **options)
+    raise ValueError('unknown baseline method: ' + str(method))
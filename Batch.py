@@ -0,0 +1,180 @@
+import argparse
+import codecs
+import csv
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from Spectra import DataHandler, FIT_TYPES, fit_components, fit_param_names, convert_axis
+from Dataset import SpectrumSet
+
+
+def find_files(patterns):  # directories are expanded to the files they contain, globs are expanded as usual
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files.extend(sorted(os.path.join(pattern, name) for name in os.listdir(pattern)
+                                if os.path.isfile(os.path.join(pattern, name))))
+        else:
+            files.extend(sorted(glob.glob(pattern)) or [pattern])
+    return files
+
+
+def result_dtype(n_params):
+    return np.dtype([('file', 'U260'), ('peak', np.int64), ('index', np.int64), ('position', np.float64),
+                     ('intensity', np.float64), ('params', np.float64, (n_params,)),
+                     ('errors', np.float64, (n_params,)), ('success', np.bool_), ('message', 'U80'),
+                     ('nfev', np.int64), ('residual', np.float64)])
+
+
+def process_file(file, settings):  # runs in a worker process, returns (result rows, number of points, seconds)
+    start = time.perf_counter()
+    handler = DataHandler(file, settings['noise_level'], line_sep=settings['line_sep'], col_sep=settings['col_sep'],
+                          dec_pt=settings['dec_pt'], min_prominence=settings['min_prominence'],
+                          min_width=settings['min_width'], min_distance=settings['min_distance'],
+                          read_workers=1)  # the files themselves are already spread over the processes
+    if settings['baseline']:
+        handler.estimate_baseline(width=settings['baseline'])
+        handler.set_baseline_subtraction(True)  # peaks are searched again on the corrected intensities
+    handler.change_units('nm')  # the exported axis is in nm
+    handler.change_units(settings['units'])
+    n_params = 0
+    if settings['fit_type'] != 'None':
+        n, with_baseline = fit_components(settings['fit_type'], settings['n_components'])
+        n_params = 3*n + with_baseline
+    rows = np.zeros(handler.pk_count, dtype=result_dtype(n_params))
+    rows['file'] = file
+    rows['peak'] = np.arange(handler.pk_count)
+    rows['index'] = handler.pk_idx
+    rows['position'] = handler.pk_lmds
+    rows['intensity'] = handler.pk_ints
+    if settings['fit_type'] != 'None':
+        table = handler.fit_peaks(settings['vicinity'], settings['fit_type'], n_components=settings['n_components'],
+                                  max_workers=1)  # the files are already spread over the cores
+        for name in ('params', 'errors', 'success', 'message', 'nfev', 'residual'):
+            rows[name] = table[name]
+    else:
+        rows['success'] = True
+    return rows, handler.size, time.perf_counter() - start
+
+
+def write_csv(path, table, param_names):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['file', 'peak', 'index', 'position', 'intensity'] + param_names +
+                        [name + '_err' for name in param_names] + ['success', 'message', 'nfev', 'residual'])
+        for row in table:
+            writer.writerow([row['file'], row['peak'], row['index'],
+                             repr(float(row['position'])), repr(float(row['intensity']))] +
+                            [repr(p) for p in row['params'].tolist()] + [repr(e) for e in row['errors'].tolist()] +
+                            [int(row['success']), row['message'], int(row['nfev']), repr(float(row['residual']))])
+
+
+def track_files(files, settings, x_lo, x_hi, normalize=None):
+    # the highest point in [x_lo, x_hi] (in settings['units']) of every file, read as one SpectrumSet on the axis
+    # of the first file; returns a table of (file, position, height), NaN where a shot has no data in the range
+    dataset = SpectrumSet.from_files(files, settings['line_sep'], settings['col_sep'], settings['dec_pt'], units='nm')
+    with np.errstate(divide='ignore'):
+        x_lo, x_hi = sorted(convert_axis(np.array([x_lo, x_hi], dtype=np.float64), settings['units'], 'nm'))
+    if normalize:
+        dataset.normalize(normalize)
+    positions, heights = dataset.track_peak(x_lo, x_hi)
+    table = np.zeros(dataset.count, dtype=[('file', 'U260'), ('position', np.float64), ('height', np.float64)])
+    table['file'] = dataset.names
+    with np.errstate(divide='ignore'):
+        table['position'] = convert_axis(positions, 'nm', settings['units'])
+    table['height'] = heights
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Find and fit peaks in a batch of spectrometer export files.')
+    parser.add_argument('inputs', nargs='+', help='files, directories or glob patterns')
+    parser.add_argument('-o', '--output', default='peaks.csv', help='.csv for text output, .npy for a binary table')
+    parser.add_argument('--line-sep', default='auto',
+                        help='line separator, escapes are allowed (default: auto - found in every file)')
+    parser.add_argument('--col-sep', default='auto', help='column separator, escapes are allowed (default: auto)')
+    parser.add_argument('--dec-pt', default='auto', choices=['auto', '.', ','])
+    parser.add_argument('--units', default='nm', choices=['nm', 'Hz', 's^-1'])
+    parser.add_argument('--noise', type=float, default=0.01, help='peak height threshold, fraction of the maximum')
+    parser.add_argument('--prominence', type=float, default=0.0, help='minimal prominence, fraction of the maximum')
+    parser.add_argument('--width', type=float, default=0.0, help='minimal peak width, in points')
+    parser.add_argument('--distance', type=int, default=1, help='minimal distance between peaks, in points')
+    parser.add_argument('--baseline', type=int, default=0,
+                        help='subtract an ALS baseline of this width in points before the peak search (default: off)')
+    parser.add_argument('--fit-type', default='Gaussian', choices=['None'] + list(FIT_TYPES))
+    parser.add_argument('--components', type=int, default=None, help='number of components for Multiplet(gaussian)')
+    parser.add_argument('--vicinity', type=int, default=20, help='points on each side of a peak used for its fit')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--track', type=float, nargs=2, default=None, metavar=('LO', 'HI'),
+                        help='instead of the peak search, follow the highest point in [LO, HI] (in --units) '
+                             'through the files, read as one series on the axis of the first file')
+    parser.add_argument('--normalize', default=None, choices=['max', 'area'],
+                        help='with --track: scale every file to unit maximum or area first')
+    args = parser.parse_args(argv)
+
+    files = find_files(args.inputs)
+    if not files:
+        parser.error('no input files found')
+    separator = lambda text: None if text == 'auto' else codecs.decode(text, 'unicode_escape')
+    settings = {'line_sep': separator(args.line_sep), 'col_sep': separator(args.col_sep),
+                'dec_pt': separator(args.dec_pt),
+                'units': args.units, 'noise_level': args.noise, 'min_prominence': args.prominence,
+                'min_width': args.width, 'min_distance': args.distance, 'fit_type': args.fit_type,
+                'n_components': args.components, 'vicinity': args.vicinity, 'baseline': args.baseline}
+    if args.track is not None:
+        start = time.perf_counter()
+        table = track_files(files, settings, args.track[0], args.track[1], args.normalize)
+        if args.output.endswith('.npy'):
+            np.save(args.output, table)
+        else:
+            with open(args.output, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['file', 'position', 'height'])
+                for row in table:
+                    writer.writerow([row['file'], repr(float(row['position'])), repr(float(row['height']))])
+        print('Tracked {} files in {:.2f} s'.format(table.size, time.perf_counter() - start), file=sys.stderr)
+        return 0
+
+    param_names = []
+    if args.fit_type != 'None':
+        param_names = fit_param_names(*fit_components(args.fit_type, args.components))
+
+    start = time.perf_counter()
+    parts, points, failed_files = [], 0, 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(process_file, file, settings): file for file in files}
+        for done, future in enumerate(as_completed(futures), 1):
+            file = futures[future]
+            try:
+                rows, size, seconds = future.result()
+            except Exception as exc:
+                failed_files += 1
+                print('[{}/{}] {}: FAILED {}: {}'.format(done, len(files), file, type(exc).__name__, exc),
+                      file=sys.stderr)
+                continue
+            parts.append(rows)
+            points += size
+            print('[{}/{}] {}: {} points, {} peaks, {:.2f} s'.format(done, len(files), file, size, rows.size, seconds),
+                  file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    table = np.concatenate(parts) if parts else np.zeros(0, dtype=result_dtype(len(param_names)))
+    table = table[np.lexsort((table['peak'], table['file']))]
+    if args.output.endswith('.npy'):
+        np.save(args.output, table)
+    else:
+        write_csv(args.output, table, param_names)
+
+    fits = int(table['success'].sum()) if args.fit_type != 'None' else 0
+    print('Processed {} files ({} failed), {} points, {} peaks, {} successful fits in {:.2f} s'.format(
+        len(files), failed_files, points, table.size, fits, elapsed), file=sys.stderr)
+    print('Throughput: {:.2f} files/s, {:.2f} Mpoints/s, {:.1f} peaks/s'.format(
+        len(files) / elapsed, points / elapsed / 1e6, table.size / elapsed), file=sys.stderr)
+    return 1 if failed_files == len(files) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
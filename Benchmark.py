@@ -0,0 +1,181 @@
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+import scipy
+from Spectra import DataHandler, FIT_TYPES, gauss, doublet_gauss, preload_modules
+
+SIZES = (10**3, 10**4, 10**5, 10**6, 10**7)
+MULTIPLET_COMPONENTS = 5  # for 'Multiplet(gaussian)', the other fit types have their own number
+
+
+def synthetic_spectrum(n, n_peaks=None, noise=0.01, seed=0):
+    # Deterministic test spectrum on a 400..800 nm grid: gauss lines with every fourth one a doublet_gauss,
+    # a constant background and gaussian noise. The same arguments always give the same arrays
+    rng = np.random.default_rng(seed)
+    lmds = np.linspace(400.0, 800.0, n)
+    step = lmds[1] - lmds[0]
+    n_peaks = max(n // 2000, 5) if n_peaks is None else n_peaks
+    ints = np.full(n, 0.05)
+    centres = np.sort(rng.uniform(410.0, 790.0, n_peaks))
+    sigmas = step * rng.uniform(3.0, 8.0, n_peaks)
+    amps = rng.uniform(0.2, 1.0, n_peaks) * sigmas * math.sqrt(2*math.pi)  # heights of 0.2..1
+    for k in range(n_peaks):  # every line is evaluated in its own +-12 sigma window only
+        lo, hi = np.searchsorted(lmds, (centres[k] - 12*sigmas[k], centres[k] + 12*sigmas[k]))
+        if k % 4 == 3:
+            ints[lo:hi] += doublet_gauss(lmds[lo:hi], amps[k], centres[k], sigmas[k],
+                                         amps[k] / 2, centres[k] + 3*sigmas[k], sigmas[k])
+        else:
+            ints[lo:hi] += gauss(lmds[lo:hi], amps[k], centres[k], sigmas[k], 0.0)
+    ints += noise * rng.standard_normal(n)
+    return lmds, ints
+
+
+def write_spectrum(path, lmds, ints):  # the default export format: tab-separated columns, '.' decimal point
+    np.savetxt(path, np.column_stack((lmds, ints)), fmt=('%.6f', '%.6e'), delimiter='\t')
+
+
+def measure(func, repeat=5, setup=None):  # (best, median) wall time of func() in seconds, setup() is not timed
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times), float(np.median(times))
+
+
+def bench_size(n, directory, repeat=5, canvas=None):  # yields result records for one spectrum size
+    path = os.path.join(directory, 'synthetic_{}.txt'.format(n))
+    if not os.path.exists(path):
+        write_spectrum(path, *synthetic_spectrum(n))
+    record = lambda name, times, items=1: {'name': name, 'size': n, 'items': items,
+                                            'best': times[0], 'median': times[1]}
+    preload_modules()  # the lazy scipy imports would otherwise be timed as part of the first import measured
+
+    yield record('import', measure(lambda: DataHandler(path, 0.05), max(repeat // 2, 1)))
+    dh = DataHandler(path, 0.05)
+    dh.change_units('nm')
+    yield record('detect_peaks', measure(lambda: dh.detect_peaks(0.05), repeat))
+
+    vicinity = 20
+    pk_nums = range(min(dh.pk_count, 1000))
+    yield record('pk_prox', measure(lambda: [dh.pk_prox(k, vicinity) for k in pk_nums], repeat), len(pk_nums))
+
+    begin, end = dh.pk_window(dh.pk_count // 2, vicinity) if dh.pk_count else (0, min(n, 2*vicinity + 1))
+    for fit_type in FIT_TYPES:
+        components = MULTIPLET_COMPONENTS if fit_type == 'Multiplet(gaussian)' else None
+        try:  # the fit cache would turn every repetition after the first one into a lookup
+            yield record('fit:' + fit_type, measure(lambda: dh.fit(begin, end, fit_type, components),
+                                                    repeat, dh.fit_cache.clear))
+        except (RuntimeError, ValueError) as exc:
+            yield {'name': 'fit:' + fit_type, 'size': n, 'error': '{}: {}'.format(type(exc).__name__, exc)}
+    dh.detect_peaks(min_prominence=0.1)  # the synthetic lines only: a global fit of every noise spike means nothing
+    try:
+        yield record('fit_global', measure(lambda: dh.fit_global(vicinity), repeat), dh.pk_count)
+    except (RuntimeError, ValueError) as exc:
+        yield {'name': 'fit_global', 'size': n, 'error': '{}: {}'.format(type(exc).__name__, exc)}
+    dh.detect_peaks(min_prominence=0.0)
+
+    def convert():
+        dh.change_units('Hz')
+        dh.change_units('nm')
+    yield record('change_units', measure(convert, repeat, dh.unit_axes.clear))
+
+    try:
+        dh.fit(begin, end, 'Gaussian')
+        for method in ('Wiener', 'Richardson-Lucy'):
+            yield record('get_conv_func:' + method,
+                         measure(lambda: dh.get_conv_func(begin, end, 'Gaussian', method), repeat, dh.deconvolver.clear))
+    except (RuntimeError, ValueError) as exc:
+        yield {'name': 'get_conv_func', 'size': n, 'error': '{}: {}'.format(type(exc).__name__, exc)}
+
+    if canvas is not None:
+        lo, hi = float(dh.lmds[0]), float(dh.lmds[0] + (dh.lmds[-1] - dh.lmds[0]) / 100)
+
+        def zoom():
+            canvas.axes.set_xlim(lo, hi)
+            canvas.draw()
+        yield record('render:set_spectrum', measure(lambda: (canvas.set_spectrum(dh.lmds, dh.ints), canvas.draw()),
+                                                    repeat))
+        yield record('render:zoom', measure(zoom, repeat, lambda: canvas.set_spectrum(dh.lmds, dh.ints)))
+
+
+def offscreen_canvas():  # (QApplication, MPLCanvas) without a window, (None, None) if Qt cannot be started here
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from PyQt5.QtWidgets import QApplication
+        from Interface import MPLCanvas
+    except ImportError as exc:
+        print('Rendering is skipped:', exc, file=sys.stderr)
+        return None, None
+    app = QApplication.instance() or QApplication([])
+    canvas = MPLCanvas(width=10, height=6, dpi=100)
+    canvas.resize(1000, 600)
+    return app, canvas
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(results, baseline, threshold=1.2):
+    # prints the ratio of every median time to the baseline run, returns the number of regressions above threshold
+    old = {(r['name'], r['size']): r for r in baseline['results'] if 'median' in r}
+    regressions = 0
+    for r in results:
+        base = old.get((r['name'], r['size']))
+        if base is None or 'median' not in r:
+            continue
+        ratio = r['median'] / base['median'] if base['median'] > 0 else float('inf')
+        flag = ''
+        if ratio > threshold:
+            regressions += 1
+            flag = '  <-- slower'
+        print('{:<32} {:>9} {:>8.2f}x{}'.format(r['name'], r['size'], ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time import, peak search, fitting, unit conversion, '
+                                                 'deconvolution and rendering on synthetic spectra.')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='JSON file for the results')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help='numbers of points')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions of every measurement')
+    parser.add_argument('--data-dir', default=None, help='where the synthetic files are kept (default: temporary)')
+    parser.add_argument('--no-render', action='store_true', help='skip the MPLCanvas measurements')
+    parser.add_argument('--compare', default=None, help='a previous JSON output to compare the medians with')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as a regression')
+    args = parser.parse_args(argv)
+
+    app, canvas = (None, None) if args.no_render else offscreen_canvas()
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = args.data_dir or tmp
+        os.makedirs(directory, exist_ok=True)
+        results = []
+        for n in args.sizes:
+            for result in bench_size(n, directory, args.repeat, canvas):
+                results.append(result)
+                if 'error' in result:
+                    print('{:<32} {:>9}  {}'.format(result['name'], n, result['error']), file=sys.stderr)
+                else:
+                    print('{:<32} {:>9} {:>10.3f} ms (best {:.3f} ms)'.format(
+                        result['name'], n, result['median'] * 1e3, result['best'] * 1e3), file=sys.stderr)
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'repeat': args.repeat, 'results': results}, f, indent=1)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            return 1 if compare(results, json.load(f), args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def default_cache_dir():
+    if os.environ.get('SPECTRUM_CACHE_DIR'):
+        return os.environ['SPECTRUM_CACHE_DIR']
+    if os.name == 'nt' and os.environ.get('LOCALAPPDATA'):
+        return os.path.join(os.environ['LOCALAPPDATA'], 'SpectrumAnalyzer', 'cache')
+    return os.path.join(os.path.expanduser('~'), '.cache', 'SpectrumAnalyzer')
+
+
+class SpectrumCache:
+    # Every entry is a group of files named <key>.<part> (data.npy, bad.npy, peaks.npz, peaks.json),
+    # the access time of an entry is the mtime of its data file, so LRU order survives restarts
+
+    def __init__(self, directory=None, max_bytes=2 * 1024**3):
+        self.directory = directory if directory is not None else default_cache_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, file, line_sep='\n', col_sep='\t', dec_pt='.', header=0):  # header - lines skipped at the start
+        st = os.stat(file)
+        ident = json.dumps([os.path.abspath(file), st.st_size, st.st_mtime_ns, line_sep, col_sep, dec_pt, header])
+        return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+    def _path(self, key, part):
+        return os.path.join(self.directory, key + '.' + part)
+
+    def _touch(self, key):
+        try:
+            os.utime(self._path(key, 'data.npy'))
+        except OSError:
+            pass
+
+    def _save(self, key, part, array):  # written next to the target and renamed, so readers never see half a file
+        path = self._path(key, part)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp, path)
+
+    def load(self, key):  # returns memory-mapped (lambdas, intensities) or None on a miss
+        try:
+            data = np.load(self._path(key, 'data.npy'), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if data.ndim != 2 or data.shape[0] != 2:
+            return None
+        self._touch(key)
+        return data[0], data[1]
+
+    def store(self, key, lmds, ints, bad_lines=()):  # bad_lines - numbers of the lines skipped as not two numbers
+        try:
+            self._save(key, 'bad.npy', np.asarray(bad_lines, dtype=np.int64))
+            self._save(key, 'data.npy', np.vstack((lmds, ints)))
+        except OSError:
+            return False
+        self.evict(keep=key)
+        return True
+
+    def load_bad_lines(self, key):  # the bad_lines stored with the data, None if unknown
+        try:
+            return np.load(self._path(key, 'bad.npy')).tolist()
+        except (OSError, ValueError):
+            return None
+
+    def load_peaks(self, key, params):  # params - json-serializable detection settings the peaks were found with
+        try:
+            with open(self._path(key, 'peaks.json'), 'r') as f:
+                if json.load(f) != json.loads(json.dumps(params)):
+                    return None
+            with np.load(self._path(key, 'peaks.npz')) as arrays:
+                return {name: arrays[name] for name in arrays.files}
+        except (OSError, ValueError):
+            return None
+
+    def store_peaks(self, key, params, peaks):  # peaks - {name: array}
+        path = self._path(key, 'peaks.npz')
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, **peaks)
+            os.replace(path + '.tmp', path)
+            with open(self._path(key, 'peaks.json'), 'w') as f:
+                json.dump(params, f)
+        except OSError:
+            return False
+        return True
+
+    def entries(self):  # {key: (last access time, total size in bytes)}
+        entries = {}
+        for name in os.listdir(self.directory):
+            key = name.split('.', 1)[0]
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            atime, size = entries.get(key, (0.0, 0))
+            if name.endswith('.data.npy'):
+                atime = st.st_mtime
+            entries[key] = (atime, size + st.st_size)
+        return entries
+
+    def remove(self, key):
+        for name in os.listdir(self.directory):
+            if name.split('.', 1)[0] == key:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:  # e.g. still memory-mapped on Windows, will be retried on the next eviction
+                    pass
+
+    def evict(self, keep=None):
+        entries = self.entries()
+        total = sum(size for _, size in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k][0]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= entries[key][1]
+
+    def clear(self):
+        for key in self.entries():
+            self.remove(key)
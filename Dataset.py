@@ -0,0 +1,153 @@
+import numpy as np
+from Spectra import read_spectrum, resolve_format, convert_axis
+
+
+def resample(lmds, ints, axis):  # ints(lmds) on another axis, linear interpolation, NaN outside the measured range
+    lmds, ints = np.asarray(lmds, dtype=np.float64), np.asarray(ints, dtype=np.float64)
+    if lmds.size > 1 and lmds[0] > lmds[-1]:  # np.interp needs an increasing axis
+        lmds, ints = lmds[::-1], ints[::-1]
+    return np.interp(axis, lmds, ints, left=np.nan, right=np.nan)
+
+
+def parabolic_peak(x, y, k):
+    # refines the maxima y[r, k[r]] of the rows of y with a parabola through the neighbouring samples,
+    # x - shared (possibly non-uniform) axis; maxima at the edges or on flat tops keep the sample values
+    rows = np.arange(y.shape[0])
+    inner = (k > 0) & (k < y.shape[1] - 1)
+    km, kp = np.clip(k - 1, 0, None), np.clip(k + 1, None, y.shape[1] - 1)
+    u0, u2 = x[km] - x[k], x[kp] - x[k]  # relative to the sample, so Hz-sized axes do not lose precision
+    d0, d2 = y[rows, km] - y[rows, k], y[rows, kp] - y[rows, k]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = u0 * u2 * (u0 - u2)
+        a = (d0 * u2 - d2 * u0) / det
+        b = (d2 * u0**2 - d0 * u2**2) / det
+        shift = np.clip(-b / (2*a), np.minimum(u0, u2), np.maximum(u0, u2))
+        height = y[rows, k] - b**2 / (4*a)
+    ok = inner & (a < 0) & np.isfinite(shift) & np.isfinite(height)
+    return np.where(ok, x[k] + shift, x[k]), np.where(ok, height, y[rows, k])
+
+
+class SpectrumSet:
+    # A series of shots as one (shots, points) stack over a shared axis. Spectra measured on another grid are
+    # resampled onto it when added. Rows are only ever views of the stack, the operations work on all of them
+    # at once and in place (dtype=np.float32 halves the memory of long series)
+
+    def __init__(self, axis, units='', capacity=0, dtype=np.float64):
+        self.axis = np.array(axis, dtype=np.float64)
+        self.axis.flags.writeable = False
+        self.units = units
+        self.stack = np.empty((capacity, self.axis.size), dtype=dtype)
+        self.count = 0
+        self.names = []
+        self.resampled = 0  # number of shots that were not on the shared axis
+
+    @classmethod
+    def from_files(cls, files, line_sep='\n', col_sep='\t', dec_pt='.', units='', axis=None, cache=None,
+                   dtype=np.float64, progress=None):
+        # the axis of the first file is the shared one unless given; progress(done, total) may raise
+        # OperationCancelled; cache - Cache.SpectrumCache or None; settings given as None are sniffed from every file
+        dataset = None
+        for done, file in enumerate(files, 1):
+            loaded = None
+            file_line_sep, file_col_sep, file_dec_pt, header = resolve_format(file, line_sep, col_sep, dec_pt)
+            if cache is not None:
+                key = cache.key(file, file_line_sep, file_col_sep, file_dec_pt, header)
+                loaded = cache.load(key)
+            if loaded is None:
+                loaded = read_spectrum(file, file_line_sep, file_col_sep, file_dec_pt, header=header)
+                if cache is not None:
+                    cache.store(key, *loaded)
+            if dataset is None:
+                dataset = cls(loaded[0] if axis is None else axis, units, len(files), dtype)
+            dataset.add(loaded[0], loaded[1], file)
+            if progress is not None:
+                progress(done, len(files))
+        return dataset
+
+    @classmethod
+    def from_handlers(cls, handlers, dtype=np.float64):  # DataHandler objects, on the axis of the first one
+        units = handlers[0].current_units
+        dataset = cls(handlers[0].lmds, units, len(handlers), dtype)
+        for handler in handlers:  # every axis in the units of the first one, whatever the handler shows now
+            lmds = handler.axis(units) if units and handler.raw_units else handler.lmds
+            dataset.add(lmds, handler.ints, handler.file)
+        return dataset
+
+    @property
+    def data(self):  # (count, points) view of the filled part of the stack
+        return self.stack[:self.count]
+
+    def spectrum(self, shot):  # (axis, intensities) of one shot, both are views
+        return self.axis, self.stack[shot]
+
+    def add(self, lmds, ints, name=''):
+        if self.count == self.stack.shape[0]:  # capacity doubles, so adding shots one by one stays linear
+            grown = np.empty((max(2 * self.count, 16), self.axis.size), dtype=self.stack.dtype)
+            grown[:self.count] = self.stack[:self.count]
+            self.stack = grown
+        if np.shape(lmds) == self.axis.shape and np.array_equal(lmds, self.axis):
+            self.stack[self.count] = ints
+        else:
+            self.stack[self.count] = resample(lmds, ints, self.axis)
+            self.resampled += 1
+        self.names.append(name)
+        self.count += 1
+        return self.count - 1
+
+    def axis_in(self, units):  # the shared axis in other units, see Spectra.UNIT_FACTORS
+        if units == self.units or self.units == '':
+            return self.axis
+        with np.errstate(divide='raise'):
+            return convert_axis(self.axis, self.units, units)
+
+    def shots(self, shots=None):
+        return self.data if shots is None else self.data[np.atleast_1d(shots)]
+
+    def mean(self, shots=None):  # points missing after resampling (NaN) are left out
+        return np.nanmean(self.shots(shots), axis=0)
+
+    def std(self, shots=None):
+        return np.nanstd(self.shots(shots), axis=0)
+
+    def subtract_background(self, background):
+        # background - array on the shared axis, or a shot number / list of shot numbers whose mean is used
+        if np.ndim(background) == 0 or np.shape(background) != self.axis.shape:
+            background = self.mean(background)
+        self.data[...] -= background
+        return self
+
+    def normalize(self, method='max', x_lo=None, x_hi=None):
+        # scales every shot to unit maximum ('max') or unit area ('area'), measured in [x_lo, x_hi] if given
+        window = self.data[:, self.window(x_lo, x_hi)]
+        if method == 'max':
+            norm = np.nanmax(window, axis=1)
+        elif method == 'area':
+            x = self.axis[self.window(x_lo, x_hi)]
+            norm = np.abs(np.nansum((window[:, 1:] + window[:, :-1]) / 2 * np.diff(x), axis=1))
+        else:
+            raise ValueError('unknown normalization: ' + str(method))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.data[...] /= np.where(norm != 0, norm, np.nan)[:, np.newaxis]
+        return self
+
+    def window(self, x_lo=None, x_hi=None):  # slice of the shared axis inside [x_lo, x_hi]
+        if x_lo is None and x_hi is None:
+            return slice(0, self.axis.size)
+        inside = np.flatnonzero((self.axis >= (-np.inf if x_lo is None else x_lo)) &
+                                (self.axis <= (np.inf if x_hi is None else x_hi)))
+        if inside.size == 0:
+            return slice(0, 0)
+        return slice(inside[0], inside[-1] + 1)
+
+    def track_peak(self, x_lo, x_hi):
+        # position and height of the highest point in [x_lo, x_hi] for every shot at once,
+        # refined between the samples; returns (positions, heights), NaN for shots without data there
+        window = self.window(x_lo, x_hi)
+        y = self.data[:, window].astype(np.float64)
+        if y.shape[1] == 0:
+            return np.full(self.count, np.nan), np.full(self.count, np.nan)
+        missing = np.isnan(y).all(axis=1)
+        k = np.nanargmax(np.where(missing[:, np.newaxis], 0.0, y), axis=1)
+        positions, heights = parabolic_peak(self.axis[window], np.nan_to_num(y, nan=-np.inf), k)
+        positions[missing], heights[missing] = np.nan, np.nan
+        return positions, heights
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+import numpy as np
+
+METHODS = ('Wiener', 'Richardson-Lucy')
+
+
+class Deconvolver:
+    # Estimates h in data = kernel (*) h, where kernel is the fitted spectrum sampled on the data grid.
+    # Both are zero-padded to a fast real-FFT length, so the convolution is linear rather than circular.
+    # The result is returned on the data grid with zero lag in the middle of the window.
+    # Kernel transforms are cached by a caller-supplied key, so repeated estimates only transform the data
+
+    def __init__(self, max_kernels=32):
+        self.max_kernels = max_kernels
+        self.kernels = OrderedDict()  # key -> (fft length, rfft of the kernel, |rfft|^2)
+
+    def kernel_transform(self, key, kernel, n, clip=False):
+        # kernel - array or a callable producing it (not called on a hit); key=None disables caching
+        if key is not None:
+            key = (key, clip)
+            entry = self.kernels.get(key)
+            if entry is not None and entry[0] >= 2*n - 1:
+                self.kernels.move_to_end(key)
+                return entry
+        from scipy.fft import rfft, next_fast_len  # imported on first use, it slows the start of the GUI down
+        kernel = kernel() if callable(kernel) else kernel
+        size = next_fast_len(2*n - 1, real=True)
+        spectrum = rfft(np.clip(kernel, 0, None) if clip else kernel, size)
+        entry = (size, spectrum, spectrum.real**2 + spectrum.imag**2)
+        if key is None:
+            return entry
+        self.kernels[key] = entry
+        while len(self.kernels) > self.max_kernels:
+            self.kernels.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def centred(h_full, n):  # lags -(n//2) ... n - n//2 - 1 of a padded result, zero lag at index n//2
+        return np.concatenate((h_full[h_full.size - n//2:], h_full[:n - n//2]))
+
+    def wiener(self, data, kernel, key=None, noise_ratio=1e-3):
+        # noise_ratio - regularization relative to the peak power of the kernel, keeps near-zero frequencies finite
+        from scipy.fft import rfft, irfft
+        n = data.size
+        size, spectrum, power = self.kernel_transform(key, kernel, n)
+        h = rfft(data, size) * np.conj(spectrum) / (power + noise_ratio * power.max())
+        return self.centred(irfft(h, size), n)
+
+    def richardson_lucy(self, data, kernel, key=None, iterations=50, eps=1e-12):
+        # multiplicative updates keep the estimate non-negative, negative samples of data and kernel become zeros
+        from scipy.fft import rfft, irfft
+        n = data.size
+        size, spectrum, _ = self.kernel_transform(key, kernel, n, clip=True)
+        data = np.clip(data, 0, None)
+        support = np.zeros(size)  # lags the estimate may occupy, as returned by centred()
+        support[:n - n//2] = 1.0
+        support[size - n//2:] = 1.0
+        valid = np.zeros(size)  # samples where data exist
+        valid[:n] = 1.0
+        norm = np.maximum(irfft(rfft(valid, size) * np.conj(spectrum), size), eps)
+        h = support / n
+        padded = np.zeros(size)
+        padded[:n] = data
+        for _ in range(iterations):
+            blurred = irfft(rfft(h, size) * spectrum, size)
+            ratio = np.where(valid > 0, padded / np.maximum(blurred, eps), 0.0)
+            h *= np.clip(irfft(rfft(ratio, size) * np.conj(spectrum), size), 0, None) / norm
+            h *= support
+        return self.centred(h, n)
+
+    def deconvolve(self, data, kernel, method='Wiener', key=None, **options):
+        if method == 'Wiener':
+            return self.wiener(data, kernel, key, **options)
+        elif method == 'Richardson-Lucy':
+            return self.richardson_lucy(data, kernel, key, **options)
+        raise ValueError('unknown deconvolution method: ' + str(method))
+
+    def clear(self):
+        self.kernels.clear()
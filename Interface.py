@@ -1,22 +1,193 @@
+import time
+START_TIME = time.perf_counter()  # for the time-to-first-window measurement, before the heavy imports
 import sys
+import os
+import multiprocessing
+import threading
 import matplotlib
 import numpy as np
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QTimer, Qt, pyqtSignal
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QApplication, QMainWindow, QHBoxLayout, QVBoxLayout, QGridLayout, QWidget, QDialog
-from PyQt5.QtWidgets import QSpinBox, QComboBox, QLabel, QPushButton, QFrame, QFileDialog
+from PyQt5.QtWidgets import QSpinBox, QDoubleSpinBox, QComboBox, QLabel, QPushButton, QFrame, QFileDialog
+from PyQt5.QtWidgets import QTableWidget, QTableWidgetItem, QProgressBar, QCheckBox
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
-from Spectra import DataHandler
-from Spectra import fitparams_textout
+from Spectra import DataHandler, OperationCancelled, preload_modules
+from Cache import SpectrumCache
+from Profiler import profiler
+from Deconvolution import METHODS as DECONVOLUTION_METHODS
+from Spectra import fitparams_textout, fit_stats_textout, fit_components, fit_param_names, FIT_TYPES
+from Spectra import UNCERTAINTY_METHODS
+from Baseline import METHODS as BASELINE_METHODS, estimate_baseline
 matplotlib.use('Qt5Agg')
 
 
+class TaskSignals(QObject):  # created in the GUI thread, so the slots connected to it run there too
+    progress = pyqtSignal(int, int)
+    partial = pyqtSignal(object)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(object)
+    cancelled = pyqtSignal()
+
+
+class Task(QRunnable):  # runs func(task, *args) on the thread pool, func reports through task.report/task.emit
+    def __init__(self, func, *args):
+        super(Task, self).__init__()
+        self.func = func
+        self.args = args
+        self.signals = TaskSignals()
+        self.cancel_event = threading.Event()
+
+    def run(self):
+        try:
+            result = self.func(self, *self.args)
+        except OperationCancelled:
+            self.signals.cancelled.emit()
+        except Exception as exc:
+            self.signals.failed.emit(exc)
+        else:
+            if self.cancel_event.is_set():
+                self.signals.cancelled.emit()
+            else:
+                self.signals.finished.emit(result)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def report(self, done, total):  # also the cancellation point of the task
+        if self.cancel_event.is_set():
+            raise OperationCancelled()
+        self.signals.progress.emit(int(1000 * done / total) if total else 0, 1000)
+
+    def emit(self, value):
+        if self.cancel_event.is_set():
+            raise OperationCancelled()
+        self.signals.partial.emit(value)
+
+
+def minmax_downsample(x, y, n_bins):  # keeps the lowest and the highest point of every bin, so no line is lost
+    n = x.size
+    if n <= 2 * n_bins + 2:
+        return x, y
+    k = n // n_bins
+    m = (n - 2) // k
+    binned = y[1:1 + m*k].reshape(m, k)
+    first = np.arange(m) * k + 1
+    pairs = np.sort(np.stack((first + binned.argmin(axis=1), first + binned.argmax(axis=1)), axis=1), axis=1)
+    rest = np.arange(1 + m*k, n - 1)  # less than one bin is left over
+    if rest.size:
+        rest = rest[[y[rest].argmin(), y[rest].argmax()]]
+        rest.sort()
+    idx = np.concatenate(([0], pairs.ravel(), rest, [n - 1]))
+    return x[idx], y[idx]
+
+
+def visible_slice(x, x_lo, x_hi):  # indexes of the points of a monotonic axis inside [x_lo, x_hi], plus one on each side
+    if x.size and x[0] > x[-1]:  # descending axis, e.g. frequencies
+        begin = x.size - np.searchsorted(x[::-1], x_hi, side='right')
+        end = x.size - np.searchsorted(x[::-1], x_lo, side='left')
+    else:
+        begin = np.searchsorted(x, x_lo, side='left')
+        end = np.searchsorted(x, x_hi, side='right')
+    return slice(max(int(begin) - 1, 0), min(int(end) + 1, x.size))
+
+
+def newest_file(directory):  # the most recently modified file of a directory, None if it has none
+    newest, newest_time = None, -1
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime_ns > newest_time:
+                    newest, newest_time = entry.path, entry.stat().st_mtime_ns
+    except OSError:
+        return None
+    return newest
+
+
 class MPLCanvas(FigureCanvasQTAgg):
+    # The artists are created once and only get new data afterwards. Overlays (fit, HW function) are animated:
+    # they are blitted over a cached background, so changing them does not re-render the spectrum
 
     def __init__(self, parent=None, width=5, height=4, dpi=100):
         fig = Figure(figsize=(width, height), dpi=dpi)
         self.axes = fig.add_subplot(111)
         super(MPLCanvas, self).__init__(fig)
+        self.spectrum_line, = self.axes.plot([], [])
+        self.fit_line, = self.axes.plot([], [], color='red', animated=True)
+        self.hw_line, = self.axes.plot([], [], color='green', animated=True)
+        self.baseline_line, = self.axes.plot([], [], color='orange', linestyle='--', animated=True)
+        self.overlays = (self.fit_line, self.hw_line, self.baseline_line)
+        self.full_x, self.full_y = np.empty(0), np.empty(0)  # the spectrum at full resolution
+        self.labels = []  # text artists of the peak labels, reused and hidden when not needed
+        self.background = None
+        self.axes.callbacks.connect('xlim_changed', self.refine_lod)
+        self.mpl_connect('draw_event', self.on_draw)
+
+    def draw(self):  # the actual rendering, draw_idle() ends up here
+        with profiler.stage('render', points=len(self.spectrum_line.get_xdata())):
+            super(MPLCanvas, self).draw()
+
+    def pixel_width(self):
+        return max(int(self.axes.bbox.width), 100)
+
+    def set_spectrum(self, x, y):  # plots about two points per pixel column, refined on every zoom or pan
+        self.full_x, self.full_y = np.asarray(x), np.asarray(y)
+        for line in self.overlays:
+            line.set_data([], [])
+        self.spectrum_line.set_data(*minmax_downsample(self.full_x, self.full_y, self.pixel_width()))
+        self.axes.relim()
+        self.axes.autoscale(enable=True)  # a zoom of the previous data must not stick
+        self.draw_idle()
+
+    def update_spectrum(self, x, y):  # new data of the same spectrum (watch mode): the view and overlays are kept
+        self.full_x, self.full_y = np.asarray(x), np.asarray(y)
+        if self.axes.get_autoscalex_on():  # not zoomed - follow the data
+            self.axes.relim()
+            self.axes.autoscale_view()
+        self.refine_lod(self.axes)
+
+    def set_labels(self, xs, ys, texts):
+        while len(self.labels) < len(texts):
+            self.labels.append(self.axes.text(0, 0, '', fontsize=7, ha='center', va='bottom', clip_on=True))
+        for k, label in enumerate(self.labels):
+            if k < len(texts):
+                label.set_position((xs[k], ys[k]))
+                label.set_text(texts[k])
+            label.set_visible(k < len(texts))
+        self.draw_idle()
+
+    def refine_lod(self, axes):
+        x_lo, x_hi = sorted(axes.get_xlim())
+        visible = visible_slice(self.full_x, x_lo, x_hi)
+        self.spectrum_line.set_data(*minmax_downsample(self.full_x[visible], self.full_y[visible], self.pixel_width()))
+        self.draw_idle()
+
+    def set_overlay(self, line, x, y, rescale=False):  # rescale - extend the view to the overlay (full redraw)
+        line.set_data(x, y)
+        if rescale:
+            self.axes.relim()
+            self.axes.autoscale_view()
+            self.draw_idle()
+        else:
+            self.blit_overlays()
+
+    def on_draw(self, event):
+        self.background = self.copy_from_bbox(self.figure.bbox)
+        for line in self.overlays:
+            self.axes.draw_artist(line)
+
+    def blit_overlays(self):
+        if self.background is None:
+            self.draw_idle()
+            return
+        self.restore_region(self.background)
+        for line in self.overlays:
+            self.axes.draw_artist(line)
+        self.blit(self.figure.bbox)
 
 
 class SettsDialog(QDialog):
@@ -25,22 +196,24 @@ class SettsDialog(QDialog):
         general_layout = QGridLayout(self)
         self.clicks = 0
         self.parent = parent
-        self.sep_dict = {'(\\n)': '\n', '(\\t)': '\t', '(; + \\n)': ';\n', '(space)': ' ', '(;)': ';', '(,)': ','}
+        self.sep_dict = {'(auto)': None, '(\\n)': '\n', '(\\t)': '\t', '(; + \\n)': ';\n', '(space)': ' ', '(;)': ';',
+                         '(,)': ','}  # None - found in the file at import
+        sep_names = {sep: name for name, sep in self.sep_dict.items()}
 
         line_sep_label = QLabel('Line separating symbol:')
         self.cmbox_line_sep = QComboBox()
         self.cmbox_line_sep.addItems(list(self.sep_dict.keys()))
-        self.cmbox_line_sep.setCurrentText('(\\n)')  # todo change to normal loading of settings
+        self.cmbox_line_sep.setCurrentText(sep_names.get(self.parent.line_separator, '(auto)'))
 
         col_sep_label = QLabel('Column separating symbol:')
         self.cmbox_col_sep = QComboBox()
         self.cmbox_col_sep.addItems(list(self.sep_dict.keys()))
-        self.cmbox_col_sep.setCurrentText('(\\t)')  # todo same as above
+        self.cmbox_col_sep.setCurrentText(sep_names.get(self.parent.column_separator, '(auto)'))
 
         decimal_point_label = QLabel('Decimal point symbol:')
         self.cmbox_decimal = QComboBox()
-        self.cmbox_decimal.addItems(['.', ','])
-        self.cmbox_decimal.setCurrentText(self.parent.decimal_point)
+        self.cmbox_decimal.addItems(['(auto)', '.', ','])
+        self.cmbox_decimal.setCurrentText(self.parent.decimal_point or '(auto)')
         self.exit_btn = QPushButton('Exit')
         self.apply_btn = QPushButton('Apply')
         general_layout.addWidget(line_sep_label, 0, 0)
@@ -63,20 +236,82 @@ class SettsDialog(QDialog):
     def btn_apply(self):
         self.parent.catchSettings(self.sep_dict[self.cmbox_line_sep.currentText()],
                                   self.sep_dict[self.cmbox_col_sep.currentText()],
-                                  self.cmbox_decimal.currentText())
+                                  self.sep_dict.get(self.cmbox_decimal.currentText(), self.cmbox_decimal.currentText()))
         self.close()
 
+class FitTableDialog(QDialog):  # results of fitting every peak, filled in as they arrive
+    def __init__(self, parent=None, param_names=(), rows=0, **kwargs):
+        super(FitTableDialog, self).__init__(parent, **kwargs)
+        self.parent = parent
+        layout = QVBoxLayout(self)
+        self.status_label = QLabel('Fitted: 0 / ' + str(rows))
+        self.table = QTableWidget(rows, len(param_names) + 3)
+        self.table.setHorizontalHeaderLabels(['Peak', 'Position'] + list(param_names) + ['Status'])
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table.cellDoubleClicked.connect(self.goToPeak)
+        layout.addWidget(self.status_label)
+        layout.addWidget(self.table)
+        self.done_count = 0
+        self.resize(800, 400)
+        self.setWindowTitle('Fit of all peaks')
+
+    def addRecord(self, row, record, position):
+        pk_num, params, success, message = record[0], record[4], record[6], record[7]
+        items = [str(pk_num), '{:.4f}'.format(position)] + ['{:.4g}'.format(p) for p in params]
+        items.append('ok' if success else (message or 'failed'))
+        for col, text in enumerate(items):
+            self.table.setItem(row, col, QTableWidgetItem(text))
+        self.done_count += 1
+        self.status_label.setText('Fitted: ' + str(self.done_count) + ' / ' + str(self.table.rowCount()))
+
+    def goToPeak(self, row, col):
+        item = self.table.item(row, 0)
+        if item is not None:
+            self.parent.spbox_pk_num.setValue(int(item.text()))
+
+
+class UncertaintyDialog(QDialog):  # resampling uncertainties of a fit: spread, interval and correlations per parameter
+    def __init__(self, parent=None, param_names=(), result=None, **kwargs):
+        super(UncertaintyDialog, self).__init__(parent, **kwargs)
+        layout = QVBoxLayout(self)
+        n = len(param_names)
+        level = '{:g}%'.format(100 * result['level'])
+        status = '{}: {} of {} refits converged'.format(result['method'], result['converged'], result['samples'])
+        if result['converged'] < 0.9 * result['samples']:  # typically a component the data do not need
+            status += ' - the fit may have more components than the data support'
+        status_label = QLabel(status)
+        table = QTableWidget(n, 4 + n)
+        table.setHorizontalHeaderLabels(['Value', 'Std. dev.', level + ' low', level + ' high'] +
+                                        ['corr ' + name for name in param_names])
+        table.setVerticalHeaderLabels(list(param_names))
+        table.setEditTriggers(QTableWidget.NoEditTriggers)
+        for row in range(n):
+            values = [result['params'][row], result['std'][row], result['lower'][row], result['upper'][row]]
+            values += list(result['correlation'][row])
+            for col, value in enumerate(values):
+                table.setItem(row, col, QTableWidgetItem('{:.4g}'.format(value) if col < 4 else '{:.2f}'.format(value)))
+        layout.addWidget(status_label)
+        layout.addWidget(table)
+        self.resize(800, 300)
+        self.setWindowTitle('Fit uncertainties')
+
+
 class MainWindow(QMainWindow):
 
     def __init__(self, *args, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
         self.canvas = MPLCanvas(self, width=5, height=4, dpi=100)
         self.data_handler = None
+        try:
+            self.spectrum_cache = SpectrumCache()
+        except OSError as exc:  # read-only home etc. - work without the cache
+            print(type(exc), exc.args)
+            self.spectrum_cache = None
         self.draw_lambda, self.draw_i = [], []
         self.file_name = ''
-        self.line_separator = '\n'
-        self.column_separator = '\t'
-        self.decimal_point = '.'
+        self.line_separator = None  # None - sniffed from every imported file
+        self.column_separator = None
+        self.decimal_point = None
         self.filename_label = QLabel('(none)')
 
 
@@ -86,16 +321,43 @@ class MainWindow(QMainWindow):
         self.spbox_pk_vic = QSpinBox()
         self.spbox_pk_vic.setMaximum(0)
         self.spbox_pk_vic.setMinimum(0)
+        self.dspbox_noise = QDoubleSpinBox()
+        self.dspbox_prominence = QDoubleSpinBox()
+        self.dspbox_width = QDoubleSpinBox()
+        self.spbox_distance = QSpinBox()
+        self.pk_found_label = QLabel('Peaks found: 0')
+        self.cmbox_baseline = QComboBox()
+        self.spbox_baseline_width = QSpinBox()
+        self.chbox_baseline_show = QCheckBox('Show')
+        self.chbox_baseline_subtract = QCheckBox('Subtract')
 
         self.cmbox_units = QComboBox()
         self.cmbox_preload = QComboBox()
+        self.chbox_labels = QCheckBox('Label peaks')
+        self.label_count = 10  # the highest peaks in view get labels
+        self.cmbox_follow = QComboBox()
+        self.follow_timer = QTimer(self)
+        self.follow_interval = 250  # ms, caps the refresh rate of the watch mode
         self.cmbox_fittype = QComboBox()
+        self.spbox_components = QSpinBox()
+        self.fit_table_dialog = None
         self.cmbox_fitdata = QComboBox()
+        self.cmbox_hw_method = QComboBox()
+        self.cmbox_uncertainty = QComboBox()
+        self.spbox_samples = QSpinBox()
+        self.uncertainty_dialog = None
         self.fitout_label = QLabel('(none)')
         self.fitout_label.setStyleSheet("QLabel{font-size: 10pt;}")
 
         self.pk_num = 0
         self.pk_vic = 1
+        self.task = None
+        self.task_label = QLabel('')
+        self.task_progress = QProgressBar()
+        self.task_cancel_btn = QPushButton('Cancel')
+        self.timing_label = QLabel('')
+        self.chbox_profile = QCheckBox('Timings')
+        self.trace_btn = QPushButton('Save trace')
         self.repr_type = 0
         self.symbols = {'nm': '$\\lambda$', 'Hz': '$\\nu$', 's^-1': '$\\omega$'}
         self.initUI()
@@ -108,9 +370,12 @@ class MainWindow(QMainWindow):
         loading_layout = QVBoxLayout()
         loadsets_layout = QHBoxLayout()
         uppershit_layout = QHBoxLayout()
+        pk_search_layout = QGridLayout()
         pk_vic_settings_layout = QGridLayout()
         fitting_general_layout = QVBoxLayout()
         fitgenset_layout = QGridLayout()
+        hw_func_layout = QHBoxLayout()
+        uncertainty_layout = QHBoxLayout()
 
         general_holder = QWidget()
         button_holder = QWidget()
@@ -118,9 +383,12 @@ class MainWindow(QMainWindow):
         loading_holder = QWidget()  # declaring these parent assholes-widgets
         loadsets_holder = QWidget()
         uppershit_holder = QWidget()
+        pk_search_holder = QWidget()
         pk_vic_settings_holder = QWidget()
         fitting_general_holder = QWidget()
         fitgenset_holder = QWidget()
+        hw_func_holder = QWidget()
+        uncertainty_holder = QWidget()
 
         load_button = QPushButton('Import data from file', self)  # creating loading button and label
         load_button.setToolTip('Choose a .txt file from nearby directory')
@@ -137,10 +405,16 @@ class MainWindow(QMainWindow):
         load_settings_button.setFixedHeight(25)
         load_settings_button.setFixedWidth(60)
         load_settings_button.clicked.connect(self.importSettingsWrapper)
+        self.cmbox_follow.addItems(['Static', 'Follow file', 'Follow directory'])
+        self.cmbox_follow.setFixedHeight(25)
+        self.cmbox_follow.setToolTip('Read data appended to the file, or switch to the newest file of its directory')
+        self.cmbox_follow.currentTextChanged.connect(self.followModeChanged)
+        self.follow_timer.timeout.connect(self.followUpdate)
         loadsets_layout.setContentsMargins(0, 0, 0, 0)
         loadsets_layout.addWidget(load_button)
         loadsets_layout.addWidget(self.cmbox_units)
         loadsets_layout.addWidget(load_settings_button)
+        loadsets_layout.addWidget(self.cmbox_follow)
         loadsets_holder.setLayout(loadsets_layout)
         self.filename_label.setFixedHeight(25)
         loading_layout.addWidget(loadsets_holder)  # putting them onto one parent-widget
@@ -164,6 +438,10 @@ class MainWindow(QMainWindow):
         self.cmbox_preload.setFixedHeight(25)
         uppershit_layout.addWidget(self.cmbox_preload)
         uppershit_layout.addWidget(draw_button)
+        self.chbox_labels.setChecked(True)
+        self.chbox_labels.setToolTip('Label the highest peaks in view; a click on the graph selects the nearest peak')
+        self.chbox_labels.toggled.connect(self.labelPeaks)
+        uppershit_layout.addWidget(self.chbox_labels)
         uppershit_layout.setContentsMargins(0, 0, 0, 0)
         uppershit_holder.setLayout(uppershit_layout)
         uppershit_holder.setFixedHeight(30)
@@ -176,6 +454,47 @@ class MainWindow(QMainWindow):
         h_line2.setFrameShape(QFrame.HLine)
         h_line2.setFrameShadow(QFrame.Sunken)
 
+        for dspbox, value, tip in ((self.dspbox_noise, 0.01, 'Minimal peak height, fraction of the maximal intensity'),
+                                   (self.dspbox_prominence, 0.0, 'Minimal prominence, fraction of the maximal intensity')):
+            dspbox.setDecimals(4)
+            dspbox.setRange(0, 1)
+            dspbox.setSingleStep(0.005)
+            dspbox.setValue(value)
+            dspbox.setToolTip(tip)
+        self.dspbox_width.setRange(0, 10000)
+        self.dspbox_width.setToolTip('Minimal peak width at half prominence, in points')
+        self.spbox_distance.setRange(1, 1000000)
+        self.spbox_distance.setToolTip('Minimal distance between neighbouring peaks, in points')
+        for spbox in (self.dspbox_noise, self.dspbox_prominence, self.dspbox_width, self.spbox_distance):
+            spbox.valueChanged.connect(self.peakSearchReload)
+        pk_search_layout.setContentsMargins(0, 0, 0, 0)
+        pk_search_layout.addWidget(QLabel('Noise level:'), 0, 0)
+        pk_search_layout.addWidget(self.dspbox_noise, 0, 1)
+        pk_search_layout.addWidget(QLabel('Min. prominence:'), 0, 2)
+        pk_search_layout.addWidget(self.dspbox_prominence, 0, 3)
+        pk_search_layout.addWidget(QLabel('Min. width:'), 1, 0)
+        pk_search_layout.addWidget(self.dspbox_width, 1, 1)
+        pk_search_layout.addWidget(QLabel('Min. distance:'), 1, 2)
+        pk_search_layout.addWidget(self.spbox_distance, 1, 3)
+        pk_search_layout.addWidget(self.pk_found_label, 2, 0, 1, 4)
+        self.cmbox_baseline.addItems(list(BASELINE_METHODS))
+        self.cmbox_baseline.setToolTip('Background estimation method')
+        self.spbox_baseline_width.setRange(1, 10000000)
+        self.spbox_baseline_width.setValue(1000)
+        self.spbox_baseline_width.setToolTip('Shortest feature of the background, in points; peaks should be narrower')
+        self.chbox_baseline_subtract.setToolTip('Search peaks and fit the spectrum with the background subtracted')
+        self.spbox_baseline_width.setKeyboardTracking(False)  # estimated once the whole number is typed in
+        self.cmbox_baseline.currentTextChanged.connect(self.baselineReload)
+        self.spbox_baseline_width.valueChanged.connect(self.baselineReload)
+        self.chbox_baseline_show.toggled.connect(self.baselineReload)
+        self.chbox_baseline_subtract.toggled.connect(self.baselineReload)
+        pk_search_layout.addWidget(QLabel('Baseline:'), 3, 0)
+        pk_search_layout.addWidget(self.cmbox_baseline, 3, 1)
+        pk_search_layout.addWidget(self.spbox_baseline_width, 3, 2)
+        pk_search_layout.addWidget(self.chbox_baseline_show, 4, 1)
+        pk_search_layout.addWidget(self.chbox_baseline_subtract, 4, 2)
+        pk_search_holder.setLayout(pk_search_layout)
+
         label_pk_num = QLabel('Peak Number:')
         label_vicinity_size = QLabel('Points in vicinity:')
         self.spbox_pk_num.valueChanged.connect(self.getPeakNum)
@@ -190,8 +509,15 @@ class MainWindow(QMainWindow):
         fitting_label = QLabel('Fitting settings')
         fittype_label = QLabel('Type of fitting function: ')
         fitdata_label = QLabel('Data used for fitting: ')
-        self.cmbox_fittype.addItems(['None', 'Gaussian', 'Doublet(gaussian)', 'Triplet(gaussian)', 'Quadruplet(gaussian)'])
-        self.cmbox_fitdata.addItems(['None', 'All', 'Current peak'])
+        self.cmbox_fittype.addItems(['None'] + list(FIT_TYPES))
+        self.cmbox_fittype.currentTextChanged.connect(self.fitTypeChanged)
+        self.spbox_components.setRange(1, 50)
+        self.spbox_components.setValue(FIT_TYPES['Multiplet(gaussian)'][0])
+        self.spbox_components.setToolTip('Number of gaussian components of the multiplet')
+        self.spbox_components.setEnabled(False)
+        self.cmbox_fitdata.addItems(['None', 'All', 'Current peak', 'All peaks (global)'])
+        self.cmbox_fitdata.setItemData(3, 'One gaussian for every detected peak and a shared baseline, fitted at once',
+                                       Qt.ToolTipRole)
         self.cmbox_fittype.setCurrentIndex(0)
         self.cmbox_fitdata.setCurrentIndex(0)
 
@@ -199,14 +525,44 @@ class MainWindow(QMainWindow):
         fitgenset_layout.addWidget(self.cmbox_fittype, 0, 1)
         fitgenset_layout.addWidget(fitdata_label, 1, 0)
         fitgenset_layout.addWidget(self.cmbox_fitdata, 1, 1)
+        fitgenset_layout.addWidget(QLabel('Components: '), 2, 0)
+        fitgenset_layout.addWidget(self.spbox_components, 2, 1)
 
         fit_button = QPushButton('Fit chosen curve')
         fit_button.clicked.connect(self.fittingWrapper)
         fit_button.setFixedHeight(35)
 
-        hw_func_button = QPushButton('Estimate HW function (WIP)')
+        fit_all_button = QPushButton('Fit all peaks')
+        fit_all_button.setToolTip('Fit every detected peak in its own vicinity, using the fitting function above')
+        fit_all_button.clicked.connect(self.fitAllWrapper)
+        fit_all_button.setFixedHeight(25)
+
+        hw_func_button = QPushButton('Estimate HW function')
+        hw_func_button.setToolTip('Deconvolve the fitted data by the fitted curve')
         hw_func_button.clicked.connect(self.hw_funcWrapper)
         hw_func_button.setFixedHeight(20)
+        self.cmbox_hw_method.addItems(list(DECONVOLUTION_METHODS))
+        self.cmbox_hw_method.setFixedHeight(20)
+        hw_func_layout.setContentsMargins(0, 0, 0, 0)
+        hw_func_layout.addWidget(hw_func_button)
+        hw_func_layout.addWidget(self.cmbox_hw_method)
+        hw_func_holder.setLayout(hw_func_layout)
+
+        uncertainty_button = QPushButton('Estimate uncertainties')
+        uncertainty_button.setToolTip('Refit resampled data around the chosen fit: confidence intervals and '
+                                      'correlations of the parameters')
+        uncertainty_button.clicked.connect(self.uncertaintyWrapper)
+        uncertainty_button.setFixedHeight(20)
+        self.cmbox_uncertainty.addItems(list(UNCERTAINTY_METHODS))
+        self.cmbox_uncertainty.setFixedHeight(20)
+        self.spbox_samples.setRange(10, 100000)
+        self.spbox_samples.setValue(200)
+        self.spbox_samples.setToolTip('Number of refits')
+        uncertainty_layout.setContentsMargins(0, 0, 0, 0)
+        uncertainty_layout.addWidget(uncertainty_button)
+        uncertainty_layout.addWidget(self.cmbox_uncertainty)
+        uncertainty_layout.addWidget(self.spbox_samples)
+        uncertainty_holder.setLayout(uncertainty_layout)
 
         h_line3 = QFrame()  # ANOTHER horizontal separation line for aesthetics
         h_line3.setFrameShape(QFrame.HLine)
@@ -220,7 +576,9 @@ class MainWindow(QMainWindow):
         fitting_general_layout.addWidget(fitting_label)
         fitting_general_layout.addWidget(fitgenset_holder)
         fitting_general_layout.addWidget(fit_button)
-        fitting_general_layout.addWidget(hw_func_button)
+        fitting_general_layout.addWidget(fit_all_button)
+        fitting_general_layout.addWidget(hw_func_holder)
+        fitting_general_layout.addWidget(uncertainty_holder)
         fitting_general_layout.addWidget(h_line3)
         fitting_general_layout.addWidget(self.fitout_label)
         fitting_general_holder.setLayout(fitting_general_layout)
@@ -228,13 +586,16 @@ class MainWindow(QMainWindow):
         button_layout.setContentsMargins(0, 0, 0, 0)
         button_layout.addWidget(uppershit_holder)  # constructing the all-controls section
         button_layout.addWidget(h_line1)
+        button_layout.addWidget(pk_search_holder)
         button_layout.addWidget(pk_vic_settings_holder)
         button_layout.addWidget(h_line2)
         button_layout.addWidget(fitting_general_holder)
         button_holder.setLayout(button_layout)
 
-        toolbar = NavigationToolbar(self.canvas, self)  # managing graph navigation controls
-        graph_layout.addWidget(toolbar)
+        self.toolbar = NavigationToolbar(self.canvas, self)  # managing graph navigation controls
+        graph_layout.addWidget(self.toolbar)
+        self.canvas.axes.callbacks.connect('xlim_changed', lambda axes: self.labelPeaks())
+        self.canvas.mpl_connect('button_press_event', self.canvasClicked)
         graph_layout.addWidget(self.canvas)
         graph_layout.addWidget(loading_holder)
         graph_holder.setLayout(graph_layout)
@@ -244,6 +605,22 @@ class MainWindow(QMainWindow):
         general_layout.addWidget(button_holder)
         general_holder.setLayout(general_layout)
         self.setCentralWidget(general_holder)
+        self.canvas.axes.set_ylabel("$I, усл.ед.$")
+        self.task_progress.setRange(0, 1000)
+        self.task_progress.setFixedWidth(200)
+        self.task_cancel_btn.clicked.connect(self.cancelTask)
+        self.chbox_profile.setChecked(profiler.enabled)
+        self.chbox_profile.setToolTip('Measure the processing stages, the latest timings are shown here')
+        self.chbox_profile.toggled.connect(self.profilingToggled)
+        self.trace_btn.setToolTip('Save the measured stages as a trace file (chrome://tracing, Perfetto)')
+        self.trace_btn.clicked.connect(self.saveTrace)
+        self.statusBar().addPermanentWidget(self.timing_label)
+        self.statusBar().addPermanentWidget(self.chbox_profile)
+        self.statusBar().addPermanentWidget(self.trace_btn)
+        self.statusBar().addPermanentWidget(self.task_label)
+        self.statusBar().addPermanentWidget(self.task_progress)
+        self.statusBar().addPermanentWidget(self.task_cancel_btn)
+        self.showTask(False)
         self.setWindowTitle('Small data acquisition program')
         self.setWindowIcon(QIcon('icon.png'))
 
@@ -278,41 +655,261 @@ class MainWindow(QMainWindow):
         self.column_separator = column_sep
         self.decimal_point = decimal_pt
 
+    def showTask(self, visible, description=''):
+        self.task_label.setText(description)
+        self.task_progress.setValue(0)
+        for widget in (self.task_label, self.task_progress, self.task_cancel_btn):
+            widget.setVisible(visible)
+        self.cmbox_units.setEnabled(not visible)  # tasks work on the axis in the units they started with
+
+    def startTask(self, description, func, *args, on_finished=None, on_partial=None, on_failed=None):
+        # long operations run on the thread pool, their results come back to the GUI thread through signals
+        self.cancelTask()
+        task = Task(func, *args)
+        task.signals.progress.connect(lambda done, total: self.task_progress.setValue(done))
+        if on_partial is not None:
+            task.signals.partial.connect(on_partial)
+        task.signals.finished.connect(lambda result: self.taskDone(task, on_finished, result))
+        task.signals.failed.connect(lambda exc: self.taskDone(task, on_failed, exc))
+        task.signals.cancelled.connect(lambda: self.taskDone(task, None, None))
+        self.task = task
+        self.showTask(True, description)
+        QThreadPool.globalInstance().start(task)
+        return task
+
+    def taskDone(self, task, callback, value):
+        if task is self.task:
+            self.task = None
+            self.showTask(False)
+        if callback is not None:
+            callback(value)
+        self.showTimings()
+
+    def windowShown(self):  # queued right after show(), so it runs once the event loop has put the window up
+        startup = time.perf_counter() - START_TIME
+        profiler.add('startup', START_TIME, startup)
+        threading.Thread(target=preload_modules, daemon=True).start()  # scipy is loaded while the user looks around
+        for arg in sys.argv[1:]:
+            if arg == '--startup-time' or arg.startswith('--startup-time='):
+                report = 'Time to first window: {:.3f} s'.format(startup)
+                if sys.stderr is not None:  # None in the --windowed build
+                    print(report, file=sys.stderr)
+                if '=' in arg:  # --startup-time=path also writes it to a file, the only output of that build
+                    with open(arg.split('=', 1)[1], 'w') as f:
+                        f.write(report + '\n')
+                QApplication.quit()
+                break
+
+    def profilingToggled(self, enabled):
+        profiler.enabled = enabled
+        if not enabled:
+            profiler.clear()
+        self.showTimings()
+
+    def showTimings(self):  # the latest measurement of every stage, the full list is in the trace file
+        self.timing_label.setText(profiler.summary() if profiler.enabled else '')
+
+    def saveTrace(self):
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        path, _ = QFileDialog.getSaveFileName(self, 'Saving a trace file', 'trace.json', 'JSON Files (*.json)',
+                                              options=options)
+        if path:
+            try:
+                profiler.export_trace(path)
+            except OSError as exc:
+                print(type(exc), exc.args)
+
+    def cancelTask(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+            self.showTask(False)
+
     def importData(self):
         self.getFileName()
+        self.importFile(self.file_name)
+
+    def importFile(self, file_name):
+        settings = dict(line_sep=self.line_separator, col_sep=self.column_separator, dec_pt=self.decimal_point,
+                        cache=self.spectrum_cache, min_prominence=self.dspbox_prominence.value(),
+                        min_width=self.dspbox_width.value(), min_distance=self.spbox_distance.value())
+        self.startTask('Importing...', self.importTask, file_name, self.dspbox_noise.value(), settings,
+                       on_finished=self.importFinished, on_failed=self.importFailed)
+
+    @staticmethod
+    def importTask(task, file_name, noise_level, settings):
+        return file_name, DataHandler(file_name, noise_level, progress=task.report, **settings)
+
+    def importFinished(self, result):
         try:
-            self.data_handler = DataHandler(self.file_name, 0.01,
-                                            line_sep=self.line_separator,
-                                            col_sep=self.column_separator,
-                                            dec_pt=self.decimal_point)
+            self.file_name, self.data_handler = result
             self.filename_label.setText(self.file_name)
             self.draw_lambda, self.draw_i = self.data_handler.lmds, self.data_handler.ints
             self.cmbox_preload.setCurrentText('All')
-            self.spbox_pk_num.setMaximum(self.data_handler.pk_count-1)
-            self.spbox_pk_vic.setMaximum(min(self.data_handler.peaks[self.pk_num][0],
-                                             self.data_handler.size - self.data_handler.peaks[self.pk_num][0] - 1))
+            self.peaksReloaded()
             self.unitsReload()
-        except FileNotFoundError:
-            self.filename_label.setText("ERROR: FileNotFound")
+            self.baselineReload()
+            self.statusBar().showMessage(self.importReport(self.data_handler), 10000)
         except Exception as exc:
+            print(type(exc), exc.args)
+
+    @staticmethod
+    def importReport(data_handler):  # e.g. 'Read as: lines (\n), columns (\t), decimal point (.); header lines: 1'
+        names = {'\n': '\\n', '\t': '\\t', ';\n': '; + \\n', ' ': 'space'}
+        line_sep, col_sep, dec_pt = data_handler.read_settings
+        report = 'Read as: lines ({}), columns ({}), decimal point ({}); header lines: {}'.format(
+            names.get(line_sep, line_sep), names.get(col_sep, col_sep), dec_pt, data_handler.header_lines)
+        bad = data_handler.bad_lines
+        if bad:
+            report += '; skipped {} bad line(s): {}'.format(len(bad), ', '.join(map(str, bad[:10])) +
+                                                           (', ...' if len(bad) > 10 else ''))
+        return report
+
+    def importFailed(self, exc):
+        if isinstance(exc, FileNotFoundError):
+            self.filename_label.setText("ERROR: FileNotFound")
+        else:
             print(type(exc))
             print(exc.args)
+            self.statusBar().showMessage('Import failed: {}: {}'.format(type(exc).__name__, exc), 10000)
+
+    def followModeChanged(self, mode):
+        if mode == 'Static':
+            self.follow_timer.stop()
+        else:
+            self.follow_timer.start(self.follow_interval)
+
+    def followUpdate(self):  # the watch mode timer: only the appended lines are parsed, the canvas keeps its view
+        if self.data_handler is None or self.task is not None:  # e.g. still importing
+            return
+        try:
+            if self.cmbox_follow.currentText() == 'Follow directory':
+                newest = newest_file(os.path.dirname(os.path.abspath(self.file_name)))
+                if newest is not None and os.path.abspath(newest) != os.path.abspath(self.file_name):
+                    self.importFile(newest)
+                    return
+            added = self.data_handler.read_appended()
+            if added < 0:  # truncated or replaced - read it anew
+                self.importFile(self.file_name)
+            elif added > 0:
+                self.peaksReloaded()
+                if self.cmbox_preload.currentText() == 'All':
+                    self.preloadChoice()
+                    self.canvas.update_spectrum(self.draw_lambda, self.draw_i)
+        except Exception as exc:
+            print(type(exc), exc.args)
+
+    def baselineReload(self):  # (re-)estimates the baseline in the background when it is needed with new settings
+        if self.data_handler is None:
+            return
+        options = {'width': self.spbox_baseline_width.value()}
+        method = self.cmbox_baseline.currentText()
+        if (self.chbox_baseline_show.isChecked() or self.chbox_baseline_subtract.isChecked()) and \
+                self.data_handler.baseline_settings != dict(options, method=method):
+            self.startTask('Estimating baseline...', self.baselineTask, self.data_handler, method, options,
+                           on_finished=self.baselineFinished, on_failed=self.taskFailed)
+        else:
+            self.baselineFinished((self.data_handler, None, None, None))
+
+    @staticmethod
+    def baselineTask(task, data_handler, method, options):
+        # only computes: the data handler is changed in baselineFinished, on the GUI thread
+        ints = data_handler.raw_ints
+        task.report(0, 1)
+        with profiler.stage('baseline', points=ints.size, method=method):
+            baseline = estimate_baseline(ints, method, **options)
+        task.report(1, 1)
+        return data_handler, baseline, method, options
+
+    def baselineFinished(self, result):
+        data_handler, baseline, method, options = result  # baseline is None if the current one is kept
+        if data_handler is not self.data_handler:
+            return
+        try:
+            if baseline is not None:
+                if baseline.size != data_handler.size:  # rows were appended meanwhile
+                    self.baselineReload()
+                    return
+                data_handler.set_baseline(baseline, method, **options)
+            self.data_handler.set_baseline_subtraction(self.chbox_baseline_subtract.isChecked())
+            self.peaksReloaded()
+            self.drawGraph()
+        except Exception as exc:
+            print(type(exc), exc.args)
+
+    def showBaseline(self):  # over the uncorrected spectrum only, with subtraction on the background is the x axis
+        x, y = [], []
+        dh = self.data_handler
+        if dh is not None and dh.baseline is not None and self.chbox_baseline_show.isChecked() and \
+                not dh.subtract_baseline:
+            if self.cmbox_preload.currentText() == 'All':
+                x, y = minmax_downsample(dh.lmds, dh.baseline, self.canvas.pixel_width())
+            elif self.cmbox_preload.currentText() == 'Peak vicinity' and dh.pk_count > 0:
+                begin, end = dh.pk_window(self.pk_num, self.pk_vic)
+                x, y = dh.lmds[begin:end], dh.baseline[begin:end]
+        self.canvas.set_overlay(self.canvas.baseline_line, x, y)
+
+    def peakSearchReload(self):
+        if self.data_handler is None:
+            return
+        try:
+            self.data_handler.detect_peaks(self.dspbox_noise.value(), self.dspbox_prominence.value(),
+                                           self.dspbox_width.value(), self.spbox_distance.value())
+            self.peaksReloaded()
+            if self.cmbox_preload.currentText() == 'Peak vicinity':
+                self.drawGraph()
+        except Exception as exc:
+            print(type(exc), exc.args)
+
+    def peaksReloaded(self):  # keeps the peak spinboxes consistent with the current peak list
+        self.pk_found_label.setText('Peaks found: ' + str(self.data_handler.pk_count))
+        self.spbox_pk_num.setMaximum(max(self.data_handler.pk_count-1, 0))
+        self.pk_num = min(self.pk_num, self.spbox_pk_num.maximum())
+        if self.data_handler.pk_count > 0:
+            self.spbox_pk_vic.setMaximum(int(min(self.data_handler.pk_idx[self.pk_num],
+                                                 self.data_handler.size - self.data_handler.pk_idx[self.pk_num] - 1)))
+        else:
+            self.spbox_pk_vic.setMaximum(0)
+        self.pk_vic = min(self.pk_vic, self.spbox_pk_vic.maximum())
+        self.labelPeaks()
+
+    def labelPeaks(self):  # the highest peaks inside the current view, found without scanning the spectrum
+        xs, ys, texts = [], [], []
+        dh = self.data_handler
+        if dh is not None and dh.pk_count > 0 and self.chbox_labels.isChecked() and \
+                self.cmbox_preload.currentText() != 'None':
+            x_lo, x_hi = self.canvas.axes.get_xlim()
+            pk_nums = dh.peak_index().top(x_lo, x_hi, self.label_count)
+            xs, ys = dh.lmds[dh.pk_idx[pk_nums]], dh.ints[dh.pk_idx[pk_nums]]
+            texts = ['#{}\n{:.3f}'.format(k, x) for k, x in zip(pk_nums.tolist(), xs.tolist())]
+        self.canvas.set_labels(xs, ys, texts)
+
+    def canvasClicked(self, event):  # a plain left click (no zoom or pan tool) selects the nearest peak
+        if self.data_handler is None or event.inaxes is not self.canvas.axes or event.button != 1 or \
+                event.xdata is None or self.toolbar.mode != '':
+            return
+        pk_num = self.data_handler.peak_index().nearest(event.xdata)
+        if pk_num >= 0:
+            self.spbox_pk_num.setValue(pk_num)
 
     def drawGraph(self):
-        self.canvas.axes.cla()
-        self.preloadChoice()
-        self.canvas.axes.set_ylabel("$I, усл.ед.$")
-        self.canvas.axes.set_xlabel(self.symbols[self.cmbox_units.currentText()] + ', ' + self.cmbox_units.currentText())
-        self.canvas.axes.plot(self.draw_lambda, self.draw_i)
-        self.canvas.draw()
-        pass
+        with profiler.stage('draw', points=len(self.draw_lambda)):
+            self.preloadChoice()
+            self.canvas.axes.set_xlabel(self.symbols[self.cmbox_units.currentText()] + ', ' +
+                                        self.cmbox_units.currentText())
+            self.canvas.set_spectrum(self.draw_lambda, self.draw_i)
+            self.showBaseline()
+            self.labelPeaks()
+        self.showTimings()
 
     def getPeakNum(self):
         self.pk_num = self.sender().value()
-        self.spbox_pk_vic.setMaximum(min(self.data_handler.peaks[self.pk_num][0],
-                                         self.data_handler.size-self.data_handler.peaks[self.pk_num][0] - 1))
-        if self.spbox_pk_vic.value() > self.spbox_pk_vic.maximum():
-            self.spbox_pk_vic.setValue(self.spbox_pk_vic.maximum())
+        self.spbox_pk_vic.blockSignals(True)  # a clamped vicinity must not trigger a second redraw via getVicSize
+        self.spbox_pk_vic.setMaximum(int(min(self.data_handler.pk_idx[self.pk_num],
+                                             self.data_handler.size-self.data_handler.pk_idx[self.pk_num] - 1)))
+        self.spbox_pk_vic.blockSignals(False)
+        self.pk_vic = self.spbox_pk_vic.value()
         if self.cmbox_preload.currentText() == 'Peak vicinity':
             self.draw_lambda, self.draw_i = self.data_handler.pk_prox(self.pk_num, self.pk_vic)
             self.drawGraph()
@@ -323,28 +920,112 @@ class MainWindow(QMainWindow):
             self.draw_lambda, self.draw_i = self.data_handler.pk_prox(self.pk_num, self.pk_vic)
             self.drawGraph()
 
+    def fitDataWindow(self):  # [begin, end) of the data chosen for fitting
+        begin, end = 0, 0
+        if self.cmbox_fitdata.currentText() in ('All', 'All peaks (global)'):
+            begin, end = 0, self.data_handler.size
+        elif self.cmbox_fitdata.currentText() == 'Current peak':
+            begin = (self.data_handler.pk_idx[self.pk_num] - self.pk_vic)
+            end = self.data_handler.pk_idx[self.pk_num] + self.pk_vic+1
+        return int(begin), int(end)
+
     def fittingWrapper(self):
-        if self.cmbox_fittype.currentIndex() == 0 or self.cmbox_fitdata.currentIndex() == 0:
+        if self.cmbox_fitdata.currentText() == 'All peaks (global)':
+            self.globalFitWrapper()
+        elif self.cmbox_fittype.currentIndex() == 0 or self.cmbox_fitdata.currentIndex() == 0 or \
+                self.data_handler is None:
             pass
         else:
-            try:
-                begin, end = 0, 0
-                if self.cmbox_fitdata.currentText() == 'All':
-                    begin, end = 0, self.data_handler.size
-                elif self.cmbox_fitdata.currentText() == 'Current peak':
-                    begin = (self.data_handler.peaks[self.pk_num][0] - self.pk_vic)
-                    end = self.data_handler.peaks[self.pk_num][0] + self.pk_vic+1
-                Rs, fitted_func_i = self.data_handler.fit(begin, end, self.cmbox_fittype.currentText())
-                params = self.data_handler.fit_params[self.cmbox_fittype.currentText()]
-                self.fitout_label.setText(fitparams_textout(params, Rs, self.cmbox_fittype.currentText()))
-                self.drawGraph()
-                self.canvas.axes.plot(np.linspace(self.data_handler.lmds[begin],
-                                                  self.data_handler.lmds[end-1],
-                                                  (end-begin)*self.data_handler.fit_func_render_pt_density),
-                                      fitted_func_i, color='red')
-                self.canvas.draw()
-            except Exception as exc:
-                print(type(exc), exc.args)
+            begin, end = self.fitDataWindow()
+            fittype = self.cmbox_fittype.currentText()
+            self.startTask('Fitting...', self.fittingTask, self.data_handler, begin, end, fittype,
+                           self.componentsChoice(), on_finished=self.fittingFinished, on_failed=self.taskFailed)
+
+    @staticmethod
+    def fittingTask(task, data_handler, begin, end, fittype, n_components):
+        Rs, fitted_func_i = data_handler.fit(begin, end, fittype, n_components=n_components, cancel=task.is_cancelled)
+        return data_handler, begin, end, fittype, Rs, fitted_func_i
+
+    def fittingFinished(self, result):
+        data_handler, begin, end, fittype, Rs, fitted_func_i = result
+        if data_handler is not self.data_handler:  # another file was imported meanwhile
+            return
+        try:
+            params, Rs = self.data_handler.fit_result(fittype)  # in the current units, whichever the fit ran in
+            self.fitout_label.setText(fitparams_textout(params, Rs, fittype) + '<br>' +
+                                      fit_stats_textout(self.data_handler.fit_stats[fittype]))
+            self.canvas.set_overlay(self.canvas.fit_line,
+                                    np.linspace(self.data_handler.lmds[begin],
+                                                self.data_handler.lmds[end-1],
+                                                (end-begin)*self.data_handler.fit_func_render_pt_density),
+                                    fitted_func_i)
+        except Exception as exc:
+            print(type(exc), exc.args)
+
+    def taskFailed(self, exc):
+        print(type(exc), exc.args)
+        self.statusBar().showMessage('{}: {}'.format(type(exc).__name__, exc), 10000)
+
+    def fitAllWrapper(self):
+        fittype = self.cmbox_fittype.currentText()
+        if self.data_handler is None or fittype == 'None':
+            return
+        n, with_baseline = fit_components(fittype, self.componentsChoice())
+        self.fit_table_dialog = FitTableDialog(self, fit_param_names(n, with_baseline), self.data_handler.pk_count)
+        self.fit_table_dialog.rejected.connect(self.cancelTask)
+        self.fit_table_dialog.show()
+        self.startTask('Fitting all peaks...', self.fitAllTask, self.data_handler, self.pk_vic, fittype,
+                       self.componentsChoice(), on_partial=self.fitAllRecord, on_failed=self.taskFailed)
+
+    @staticmethod
+    def fitAllTask(task, data_handler, vicinity, fittype, n_components):
+        results = data_handler.iter_fit_peaks(vicinity, fittype, n_components=n_components)
+        try:
+            for done, (row, record) in enumerate(results, 1):
+                task.emit((data_handler, row, record))  # results stream into the table while the workers go on
+                task.report(done, data_handler.pk_count)
+        finally:
+            results.close()  # shuts the process pool down when cancelled
+
+    def fitAllRecord(self, value):
+        data_handler, row, record = value
+        if data_handler is self.data_handler and self.fit_table_dialog is not None:
+            self.fit_table_dialog.addRecord(row, record, self.data_handler.lmds[record[1]])
+
+    def globalFitWrapper(self):  # the fit type does not matter here, every peak is a single gaussian
+        if self.data_handler is None or self.data_handler.pk_count == 0:
+            return
+        self.startTask('Fitting all peaks at once...', self.globalFitTask, self.data_handler, self.pk_vic,
+                       on_finished=self.globalFitFinished, on_failed=self.taskFailed)
+
+    @staticmethod
+    def globalFitTask(task, data_handler, vicinity):
+        return data_handler, data_handler.fit_global(vicinity, cancel=task.is_cancelled)
+
+    def globalFitFinished(self, result):
+        data_handler, table = result
+        if data_handler is not self.data_handler:
+            return
+        try:
+            stats = self.data_handler.global_fit['stats']
+            self.fitout_label.setText('Global fit of {} peaks, baseline with {} knots{};<br>'.format(
+                table.size, stats['knots'], '' if stats['success'] else ' (not converged)') + fit_stats_textout(stats))
+            self.canvas.set_overlay(self.canvas.fit_line, self.data_handler.lmds, self.data_handler.global_fit['fitted'])
+            self.fit_table_dialog = FitTableDialog(self, fit_param_names(1, False), table.size)
+            for row, record in enumerate(table.tolist()):
+                self.fit_table_dialog.addRecord(row, record, self.data_handler.lmds[record[1]])
+            self.fit_table_dialog.setWindowTitle('Global fit of all peaks')
+            self.fit_table_dialog.show()
+        except Exception as exc:
+            print(type(exc), exc.args)
+
+    def fitTypeChanged(self, fit_type):
+        self.spbox_components.setEnabled(fit_type == 'Multiplet(gaussian)')
+
+    def componentsChoice(self):  # None lets DataHandler use the default number of components of the fit type
+        if self.cmbox_fittype.currentText() == 'Multiplet(gaussian)':
+            return self.spbox_components.value()
+        return None
 
     def hw_funcWrapper(self):
         fittype = self.cmbox_fittype.currentText()
@@ -355,26 +1036,66 @@ class MainWindow(QMainWindow):
             print(type(exc), exc.args)
             params = np.asarray([])
         if len(params) != 0:
-            try:
-                begin, end = 0, 0
-                if self.cmbox_fitdata.currentText() == 'All':
-                    begin, end = 0, self.data_handler.size
-                elif self.cmbox_fitdata.currentText() == 'Current peak':
-                    begin = (self.data_handler.peaks[self.pk_num][0] - self.pk_vic)
-                    end = self.data_handler.peaks[self.pk_num][0] + self.pk_vic + 1
-                hw_func = self.data_handler.get_conv_func(begin, end, fit_type=fittype)
-                self.canvas.axes.plot([self.data_handler.lmds[i] for i in range(begin, end)], hw_func, color='green')
-                self.canvas.draw()
-            except Exception as exc:
-                print(type(exc), exc.args)
+            begin, end = self.fitDataWindow()
+            self.startTask('Estimating HW function...', self.hw_funcTask, self.data_handler, begin, end, fittype,
+                           self.cmbox_hw_method.currentText(), on_finished=self.hw_funcFinished,
+                           on_failed=self.taskFailed)
+
+    @staticmethod
+    def hw_funcTask(task, data_handler, begin, end, fittype, method):
+        return data_handler, begin, end, data_handler.get_conv_func(begin, end, fit_type=fittype, method=method)
+
+    def hw_funcFinished(self, result):
+        data_handler, begin, end, hw_func = result
+        if data_handler is not self.data_handler:
+            return
+        try:
+            self.canvas.set_overlay(self.canvas.hw_line, self.data_handler.lmds[begin:end], hw_func, rescale=True)
+        except Exception as exc:
+            print(type(exc), exc.args)
+
+    def uncertaintyWrapper(self):
+        fittype = self.cmbox_fittype.currentText()
+        if self.data_handler is None or fittype not in FIT_TYPES or self.cmbox_fitdata.currentText() not in \
+                ('All', 'Current peak'):
+            return
+        begin, end = self.fitDataWindow()
+        self.startTask('Estimating uncertainties...', self.uncertaintyTask, self.data_handler, begin, end, fittype,
+                       self.componentsChoice(), self.cmbox_uncertainty.currentText(), self.spbox_samples.value(),
+                       on_finished=self.uncertaintyFinished, on_failed=self.taskFailed)
+
+    @staticmethod
+    def uncertaintyTask(task, data_handler, begin, end, fittype, n_components, method, n_samples):
+        result = data_handler.fit_uncertainty(begin, end, fittype, n_components=n_components, method=method,
+                                              n_samples=n_samples, cancel=task.is_cancelled)
+        return data_handler, fittype, n_components, result
+
+    def uncertaintyFinished(self, result):
+        data_handler, fittype, n_components, result = result
+        if data_handler is not self.data_handler:
+            return
+        try:
+            n, with_baseline = fit_components(fittype, n_components)
+            self.uncertainty_dialog = UncertaintyDialog(self, fit_param_names(n, with_baseline), result)
+            self.uncertainty_dialog.show()
+        except Exception as exc:
+            print(type(exc), exc.args)
 
     def unitsReload(self):
+        if self.data_handler is None:
+            return
         self.data_handler.change_units(self.cmbox_units.currentText())
+        fittype = self.cmbox_fittype.currentText()
+        if fittype in FIT_TYPES and len(self.data_handler.fit_params[fittype]) != 0:  # show the fit in the new units
+            params, errors = self.data_handler.fit_result(fittype)
+            self.fitout_label.setText(fitparams_textout(params, errors, fittype) + '<br>' +
+                                      fit_stats_textout(self.data_handler.fit_stats[fittype]))
         self.drawGraph()
-        pass
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # worker processes of the batch fit re-enter the one-file build
     app = QApplication(sys.argv)
     w = MainWindow()
+    QTimer.singleShot(0, w.windowShown)
     app.exec_()
@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+class Stage:  # times a with-block and records it on exit, set() attaches counts found inside the block
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.profiler.add(self.name, self.start, duration, **self.args)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+class NullStage:  # what stage() returns while profiling is off, so the instrumented code costs one call
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class Profiler:
+    # Wall time and counts (points, function evaluations...) of the processing stages. Events are kept in a
+    # bounded queue for a trace file, the latest event of every stage is kept for a short summary
+
+    def __init__(self, enabled=False, max_events=100000):
+        self.enabled = enabled
+        self.origin = time.perf_counter()
+        self.events = deque(maxlen=max_events)  # (name, start, duration, thread id, args)
+        self.latest = {}  # stage name -> the same tuple
+
+    def stage(self, name, **args):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name, args)
+
+    def add(self, name, start, duration, **args):  # for stages timed by the caller; may be called from any thread
+        if not self.enabled:
+            return
+        event = (name, start, duration, threading.get_ident(), args)
+        self.events.append(event)
+        self.latest[name] = event
+
+    def summary(self, names=None):  # e.g. 'read 120.3 ms (points=200001); peaks 8.1 ms (peaks=52)'
+        parts = []
+        for name in names or list(self.latest):
+            event = self.latest.get(name)
+            if event is None:
+                continue
+            args = ', '.join('{}={}'.format(key, value) for key, value in event[4].items())
+            parts.append('{} {:.1f} ms'.format(name, event[2] * 1e3) + (' (' + args + ')' if args else ''))
+        return '; '.join(parts)
+
+    def export_trace(self, path):  # Chrome trace event format (chrome://tracing, Perfetto)
+        pid = os.getpid()
+        trace = [{'name': name, 'ph': 'X', 'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6,
+                  'pid': pid, 'tid': tid, 'args': {key: str(value) for key, value in args.items()}}
+                 for name, start, duration, tid, args in list(self.events)]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    def clear(self):
+        self.events.clear()
+        self.latest.clear()
+
+
+profiler = Profiler(enabled=os.environ.get('SPECTRUM_PROFILE', '') not in ('', '0'))
+# the instance used by Spectra and Interface, SPECTRUM_PROFILE=1 turns it on from the start
@@ -1,30 +1,74 @@
-from matplotlib import pyplot as plt
 import numpy as np
-from scipy.optimize import curve_fit
-from scipy.fft import fft, ifft
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import OrderedDict
 import math
+import heapq
+import importlib
+import io
+import os
+import warnings
+from Deconvolution import Deconvolver
+from Baseline import estimate_baseline
+from Profiler import profiler
+
+# scipy.optimize and scipy.signal take most of the import time, so they are imported by the functions using them
+# (or ahead of time by preload_modules, e.g. in a background thread once the GUI is up)
+HEAVY_MODULES = ('scipy.optimize', 'scipy.signal', 'scipy.fft')
+
+
+FIT_TYPES = {'Gaussian': (1, True), 'Doublet(gaussian)': (2, False), 'Triplet(gaussian)': (3, False),
+             'Quadruplet(gaussian)': (4, False), 'Multiplet(gaussian)': (5, False)}
+# fit type -> (default number of gaussian components, constant baseline term);
+# the number of components of 'Multiplet(gaussian)' is meant to be chosen by the caller
+UNCERTAINTY_METHODS = ('Residual bootstrap', 'Pairs bootstrap', 'Monte Carlo')  # see fit_uncertainty
+SNIFF_FORMATS = (('\t', '.'), ('\t', ','), (';', '.'), (';', ','), (',', '.'), (' ', '.'), (' ', ','))
+# (column separator, decimal point) pairs tried by sniff_format
+PARALLEL_READ_BYTES = 1 << 26  # files from 64 MB on are parsed in chunks across processes
+
+
+def multi_gauss(x, *params):  # params = A_1, x_1, s_1, ..., A_n, x_n, s_n[, delta]
+    x = np.asarray(x, dtype=float)
+    p = np.asarray(params, dtype=float)
+    n = p.size // 3
+    shape = (n,) + (1,) * x.ndim  # components go along the first axis, all of them are evaluated at once
+    amp, x_0, sigma = p[0:3*n:3].reshape(shape), p[1:3*n:3].reshape(shape), p[2:3*n:3].reshape(shape)
+    f = ((amp / (sigma * np.sqrt(2*math.pi))) * np.exp(-((x - x_0) / sigma)**2 / 2)).sum(axis=0)
+    if p.size % 3:
+        f = f + p[-1]
+    return f
+
+
+def multi_gauss_jac(x, *params):  # analytic derivatives of multi_gauss, shape (len(x), len(params))
+    x = np.asarray(x, dtype=float).ravel()
+    p = np.asarray(params, dtype=float)
+    n = p.size // 3
+    amp, x_0, sigma = p[0:3*n:3, np.newaxis], p[1:3*n:3, np.newaxis], p[2:3*n:3, np.newaxis]
+    z = (x - x_0) / sigma
+    g = np.exp(-z**2 / 2) / (sigma * np.sqrt(2*math.pi))
+    term = amp * g / sigma
+    jac = np.empty((p.size, x.size))
+    jac[0:3*n:3] = g
+    jac[1:3*n:3] = term * z
+    jac[2:3*n:3] = term * (z**2 - 1)
+    if p.size % 3:
+        jac[-1] = 1.0
+    return jac.T
 
 
 def gauss(x, A_0, x_0, sigma, delta):
-    return np.add((A_0/(sigma*np.sqrt(2*math.pi)))*np.exp(-1*((x-x_0)/sigma)**2/2), delta)
+    return multi_gauss(x, A_0, x_0, sigma, delta)
 
 
 def doublet_gauss(x, A_1, x_1, s_1, A_2, x_2, s_2):
-    return (A_1/(s_1*np.sqrt(2*math.pi)))*np.exp(-1*((x-x_1)/s_1)**2/2) + \
-           (A_2/(s_2*np.sqrt(2*math.pi)))*np.exp(-1*((x-x_2)/s_2)**2/2)
+    return multi_gauss(x, A_1, x_1, s_1, A_2, x_2, s_2)
 
 
-def triplet_gauss(x, A_1, x_1, s_1, A_2, x_2, s_2, A_3, x_3, s_3):  # todo add delta, as with regular gaussian
-    return (A_1/(s_1*np.sqrt(2*math.pi)))*np.exp(-1*((x-x_1)/s_1)**2/2) + \
-           (A_2/(s_2*np.sqrt(2*math.pi)))*np.exp(-1*((x-x_2)/s_2)**2/2) + \
-           (A_3/(s_3*np.sqrt(2*math.pi)))*np.exp(-1*((x-x_3)/s_3)**2/2)
+def triplet_gauss(x, A_1, x_1, s_1, A_2, x_2, s_2, A_3, x_3, s_3):
+    return multi_gauss(x, A_1, x_1, s_1, A_2, x_2, s_2, A_3, x_3, s_3)
 
 
 def quadruplet_gauss(x, A_1, x_1, s_1, A_2, x_2, s_2, A_3, x_3, s_3, A_4, x_4, s_4):
-    return (A_1/(s_1*np.sqrt(2*math.pi)))*np.exp(-1*((x-x_1)/s_1)**2/2) + \
-           (A_2/(s_2*np.sqrt(2*math.pi)))*np.exp(-1*((x-x_2)/s_2)**2/2) + \
-           (A_3/(s_3*np.sqrt(2*math.pi)))*np.exp(-1*((x-x_3)/s_3)**2/2) + \
-           (A_4/(s_4*np.sqrt(2*math.pi)))*np.exp(-1*((x-x_4)/s_4)**2/2)
+    return multi_gauss(x, A_1, x_1, s_1, A_2, x_2, s_2, A_3, x_3, s_3, A_4, x_4, s_4)
 
 
 def fitparams_textout(params, params_sigma, fit_type):  # todo make print out a formula using LaTeX symbols
@@ -37,161 +81,1319 @@ def fitparams_textout(params, params_sigma, fit_type):  # todo make print out a
             ';<br>\u03c3 = ' + '{:.3f}'.format(params[2]) + ';  err = ' + '{:.4f}'.format(params_sigma[2]) + \
             ';<br>(HWHM = ' + '{:.3f}'.format(2*math.sqrt(2*math.log(2)) * params[2]) + ');' + \
             '<br>\u03b4 = ' + '{:.3f}'.format(params[3]) + ';  err = ' + '{:.4f}'.format(params_sigma[3])
-    elif fit_type == 'Doublet(gaussian)':
-        return 'A<sub>i</sub> = ' + '({:.3f}, {:.3f})'.format(params[0], params[3]) + \
-               ';<br>x<sub>0</sub> = ' + '({:.3f}, {:.3f})'.format(params[1], params[4]) + \
-               ';<br>\u03c3<sub>i</sub> = ' + '({:.3f}, {:.3f})'.format(params[2], params[5])
-    elif fit_type == 'Triplet(gaussian)':
-        return 'A<sub>i</sub> = ' + '({:.3f}, {:.3f}, {:.3f})'.format(params[0], params[3], params[6]) + \
-               ';<br>x<sub>0</sub> = ' + '({:.3f}, {:.3f}, {:.3f})'.format(params[1], params[4], params[7]) + \
-               ';<br>\u03c3<sub>i</sub> = ' + '({:.3f}, {:.3f}, {:.3f})'.format(params[2], params[5], params[8])
-    elif fit_type == 'Quadruplet(gaussian)':
-        return 'A<sub>i</sub> = ' + '({:.3f}, {:.3f}, {:.3f}, {:.3f})'.format(params[0], params[3], params[6], params[9]) + \
-               ';<br>x<sub>0</sub> = ' + '({:.3f}, {:.3f}, {:.3f}, {:.3f})'.format(params[1], params[4], params[7], params[10]) + \
-               ';<br>\u03c3<sub>i</sub> = ' + '({:.3f}, {:.3f}, {:.3f}, {:.3f})'.format(params[2], params[5], params[8], params[11])
+    elif fit_type in FIT_TYPES:
+        n = len(params) // 3
+        fmt = '(' + ', '.join(['{:.3f}'] * n) + ')'
+        text = 'A<sub>i</sub> = ' + fmt.format(*params[0:3*n:3]) + \
+               ';<br>x<sub>0</sub> = ' + fmt.format(*params[1:3*n:3]) + \
+               ';<br>\u03c3<sub>i</sub> = ' + fmt.format(*params[2:3*n:3])
+        if len(params) % 3:
+            text += ';<br>\u03b4 = ' + '{:.3f}'.format(params[-1])
+        return text
     else:
         return 'error'
 
 
+def preload_modules():  # imports HEAVY_MODULES, so the first fit or peak search does not wait for them
+    for name in HEAVY_MODULES:
+        with profiler.stage('preload', module=name):
+            importlib.import_module(name)
+
+
+class OperationCancelled(Exception):  # raised from progress/cancel callbacks to abort a long operation
+    pass
+
+
+def shutdown_executor(executor, futures):  # drops the work not started yet and returns at once
+    for future in futures:  # by hand, as shutdown(cancel_futures=True) needs Python 3.9
+        future.cancel()
+    executor.shutdown(wait=False)
+
+
+def fields_per_line(text):  # number of whitespace-separated fields on each line of text, vectorized
+    codes = np.frombuffer(text.encode('latin-1'), dtype=np.uint8)
+    blank = (codes == ord(' ')) | (codes == ord('\t')) | (codes == ord('\n'))
+    starts = np.flatnonzero(~blank & np.concatenate(([True], blank[:-1])))  # first characters of the fields
+    line_ends = np.flatnonzero(codes == ord('\n'))
+    counts = np.bincount(np.searchsorted(line_ends, starts), minlength=line_ends.size + 1)
+    return counts[:-1] if text.endswith('\n') else counts  # nothing follows the last line separator
+
+
+def parse_block(text, line_sep='\n', col_sep='\t', dec_pt='.', bad_lines=None):
+    # (rows, 2) array from complete lines of text; lines that are not two numbers are skipped,
+    # their 0-based numbers within text are appended to bad_lines if it is given
+    if '\r' in text:
+        text = text.replace('\r\n', '\n')
+    if line_sep != '\n':
+        text = text.replace(line_sep, '\n')
+        if line_sep.endswith('\n') and text.endswith(line_sep[:-1]):  # e.g. the ';' of a last line still unterminated
+            text = text[:len(text) - len(line_sep) + 1]
+    if dec_pt != '.':
+        text = text.replace(dec_pt, '.')
+    if not text.strip():
+        return np.empty((0, 2))
+    if col_sep in ('\t', ' ') and np.all(fields_per_line(text) == 2):
+        # two columns of plain numbers on every line are read by the fastest parser numpy has;
+        try:  # it stops early (with a warning or an error, depending on numpy) at anything else
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', DeprecationWarning)
+                values = np.fromstring(text, dtype=np.float64, sep=' ')
+        except ValueError:
+            values = None
+        if values is not None and values.size == 2 * (text.count('\n') + (not text.endswith('\n'))):
+            return values.reshape(-1, 2)
+    delimiter = None if col_sep == ' ' else col_sep  # runs of spaces are treated as one separator
+    try:
+        return np.loadtxt(io.StringIO(text), delimiter=delimiter, usecols=(0, 1), dtype=np.float64, ndmin=2)
+    except (ValueError, IndexError):  # a header or a broken line: this block is parsed again line by line
+        pass
+    rows = []
+    for k, line in enumerate(text.split('\n')):
+        line = line.split('#', 1)[0]  # comments, as loadtxt skips them
+        if not line.strip():
+            continue
+        fields = line.split(delimiter)
+        try:
+            rows.append((float(fields[0]), float(fields[1])))
+        except (ValueError, IndexError):
+            if bad_lines is not None:
+                bad_lines.append(k)
+    return np.array(rows, dtype=np.float64).reshape(-1, 2)
+
+
+def is_pair(line, col_sep, dec_pt):  # whether a line of text starts with two numbers in this format
+    if dec_pt != '.':
+        line = line.replace(dec_pt, '.')
+    fields = line.split(None if col_sep == ' ' else col_sep)
+    try:
+        float(fields[0])
+        float(fields[1])
+        return True
+    except (ValueError, IndexError):
+        return False
+
+
+def sniff_format(file, sample_bytes=1 << 16, formats=SNIFF_FORMATS):
+    # (line_sep, col_sep, dec_pt, header lines) guessed from the start of a file: the separators that read
+    # the most lines as two numbers (the first of equally good ones, in the order of formats),
+    # the header is the lines before the first of them. Raises ValueError if no line is two numbers
+    with open(file, 'rb') as f:
+        sample = f.read(sample_bytes)
+        whole = not f.read(1)
+    lines = sample.decode('latin-1').replace('\r\n', '\n').split('\n')
+    if not whole and len(lines) > 1:
+        lines = lines[:-1]  # the sample ends in the middle of a line
+    line_sep = '\n'
+    filled = [line.rstrip() for line in lines if line.strip()]
+    if filled and sum(line.endswith(';') for line in filled) >= 0.9 * len(filled):
+        line_sep = ';\n'
+        lines = [line.rstrip()[:-1] if line.rstrip().endswith(';') else line for line in lines]
+    best = None
+    for col_sep, dec_pt in formats:
+        numeric = [k for k, line in enumerate(lines) if is_pair(line, col_sep, dec_pt)]
+        if numeric and (best is None or len(numeric) > best[0]):
+            best = (len(numeric), col_sep, dec_pt, numeric[0])
+    if best is None:
+        raise ValueError('no lines of two numbers in the first {} bytes of {}'.format(len(sample), file))
+    return line_sep, best[1], best[2], best[3]
+
+
+def resolve_format(file, line_sep=None, col_sep=None, dec_pt=None, header=None):
+    # the import settings with the ones given as None taken from sniff_format; a file that cannot be sniffed
+    # keeps the settings given and no header
+    if None not in (line_sep, col_sep, dec_pt, header):
+        return line_sep, col_sep, dec_pt, header
+    formats = SNIFF_FORMATS if None in (col_sep, dec_pt) else ((col_sep, dec_pt),)  # the header in the given format
+    try:
+        sniffed = sniff_format(file, formats=formats)
+    except ValueError:
+        if None in (line_sep, col_sep, dec_pt):
+            raise
+        sniffed = (line_sep, col_sep, dec_pt, 0)
+    return tuple(sniffed[k] if value is None else value for k, value in enumerate((line_sep, col_sep, dec_pt, header)))
+
+
+def record_separator(line_sep):
+    # bytes the readers split a file at: a line separator ending in '\n' (e.g. ';\n') is split at '\n' alone,
+    # as the file may have '\r\n' line ends and the header lines need not end in ';' - parse_block removes the rest
+    return b'\n' if line_sep.endswith('\n') else line_sep.encode('latin-1')
+
+
+def skip_lines(f, sep, count, block_size=1 << 16):  # moves a binary file past count line separators, returns where
+    pos = f.tell()
+    while count > 0:
+        block = f.read(block_size)
+        if not block:
+            break
+        start = 0
+        while count > 0:
+            found = block.find(sep, start)
+            if found < 0:
+                break
+            start = found + len(sep)
+            count -= 1
+        if count == 0:
+            pos += start
+        else:  # a separator split between blocks is found again from its first byte
+            keep = min(len(sep) - 1, len(block))
+            pos += len(block) - keep
+        f.seek(pos)
+    return pos
+
+
+def read_lines(f, line_sep='\n', col_sep='\t', dec_pt='.', progress=None, total=0, block_size=1 << 24,
+               bad_lines=None, first_line=1):
+    # parses the complete lines of a binary file from its current position to the end, in blocks; returns
+    # ((rows, 2) array, bytes after the last line separator, number of complete lines) - the bytes may be a line
+    # still being written. Numbers of the lines that are not two numbers go to bad_lines, counted from first_line
+    sep = record_separator(line_sep)
+    parts = [np.empty((0, 2))]
+    done = 0
+    lines = 0
+    tail = b''
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        done += len(block)
+        block = tail + block
+        cut = block.rfind(sep)
+        if cut < 0:
+            tail = block
+            continue
+        tail = block[cut + len(sep):]
+        bad = []
+        with profiler.stage('parse', bytes=cut) as stage:
+            parts.append(parse_block(block[:cut + len(sep)].decode('latin-1'), line_sep, col_sep, dec_pt, bad))
+            stage.set(rows=parts[-1].shape[0])
+        if bad_lines is not None:
+            bad_lines.extend(first_line + lines + k for k in bad)
+        lines += block.count(sep, 0, cut + len(sep))
+        if progress is not None:
+            progress(min(done, total), total)
+    return np.concatenate(parts), tail, lines
+
+
+def next_line_start(f, pos, end, sep, block_size=1 << 16):  # just after the first separator at or after pos, or None
+    f.seek(pos)
+    buf = b''
+    while pos + len(buf) < end:
+        block = f.read(min(block_size, end - pos - len(buf)))
+        if not block:
+            break
+        buf += block
+        found = buf.find(sep)
+        if found >= 0:
+            return pos + found + len(sep)
+        keep = len(sep) - 1  # a separator split between blocks
+        pos += len(buf) - keep
+        buf = buf[len(buf) - keep:]
+    return None
+
+
+def _parse_chunk(file, start, stop, line_sep, col_sep, dec_pt, last):  # runs in the worker processes of read_chunks
+    with open(file, 'rb') as f:
+        f.seek(start)
+        data = f.read(stop - start)
+    sep = record_separator(line_sep)
+    tail = b''
+    if last:  # the end of the file may be an unterminated line
+        cut = data.rfind(sep)
+        data, tail = (b'', data) if cut < 0 else (data[:cut + len(sep)], data[cut + len(sep):])
+    bad = []
+    rows = parse_block(data.decode('latin-1'), line_sep, col_sep, dec_pt, bad)
+    return rows, bad, data.count(sep), tail
+
+
+def read_chunks(file, start, end, line_sep='\n', col_sep='\t', dec_pt='.', progress=None, max_workers=None,
+                chunk_bytes=1 << 24, bad_lines=None, first_line=1):
+    # read_lines for a large file: bytes [start, end) are cut into chunks of whole lines, which are parsed in
+    # parallel processes and joined in the file order; returns the same as read_lines
+    sep = record_separator(line_sep)
+    cuts = [start]
+    with open(file, 'rb') as f:
+        while cuts[-1] + chunk_bytes < end:
+            cut = next_line_start(f, cuts[-1] + chunk_bytes, end, sep)
+            if cut is None or cut >= end:
+                break
+            cuts.append(cut)
+    cuts.append(end)
+    results, futures = [], []
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        with profiler.stage('parse', bytes=end - start, chunks=len(cuts) - 1):
+            futures = [executor.submit(_parse_chunk, file, a, b, line_sep, col_sep, dec_pt, b == end)
+                       for a, b in zip(cuts[:-1], cuts[1:])]
+            for future, b in zip(futures, cuts[1:]):
+                results.append(future.result())
+                if progress is not None:
+                    progress(b, end)
+    finally:  # also reached when progress cancels the import
+        shutdown_executor(executor, futures)
+    lines = 0
+    for rows, bad, count, tail in results:
+        if bad_lines is not None:
+            bad_lines.extend(first_line + lines + k for k in bad)
+        lines += count
+    return np.concatenate([np.empty((0, 2))] + [result[0] for result in results]), results[-1][3], lines
+
+
+def read_spectrum_state(file, line_sep='\n', col_sep='\t', dec_pt='.', progress=None, block_size=1 << 24,
+                        header=None, max_workers=None, bad_lines=None):
+    # read_spectrum that also returns where the complete lines end in the file (in bytes)
+    # and how many rows were parsed from the unterminated last line, for appending reads later.
+    # header - lines skipped at the start, sniffed if None; files of PARALLEL_READ_BYTES and more are read by read_chunks
+    line_sep, col_sep, dec_pt, header = resolve_format(file, line_sep, col_sep, dec_pt, header)
+    total = os.path.getsize(file)
+    sep = record_separator(line_sep)
+    with open(file, 'rb') as f:
+        start = skip_lines(f, sep, header)
+        if total - start >= PARALLEL_READ_BYTES and max_workers != 1 and (max_workers or os.cpu_count() or 1) > 1:
+            rows, tail, lines = read_chunks(file, start, total, line_sep, col_sep, dec_pt, progress, max_workers,
+                                            block_size, bad_lines, header + 1)
+            offset = total - len(tail)
+        else:
+            rows, tail, lines = read_lines(f, line_sep, col_sep, dec_pt, progress, total, block_size, bad_lines,
+                                           header + 1)
+            offset = f.tell() - len(tail)
+    bad = []
+    last = parse_block(tail.decode('latin-1'), line_sep, col_sep, dec_pt, bad)
+    if bad_lines is not None and bad:
+        bad_lines.append(header + lines + 1)
+    data = np.concatenate((rows, last)).T.copy()  # one (2, size) block: both rows are contiguous
+    return data[0], data[1], offset, len(last)
+
+
+def read_spectrum(file, line_sep='\n', col_sep='\t', dec_pt='.', progress=None, block_size=1 << 24, header=None):
+    # returns (lambdas, intensities) as float64 arrays; the file is parsed in blocks of whole lines,
+    # after each of them progress(bytes read, file size) is called - it may raise OperationCancelled.
+    # Settings and header lines given as None are sniffed from the file (see resolve_format)
+    return read_spectrum_state(file, line_sep, col_sep, dec_pt, progress, block_size, header)[:2]
+
+
+def line_end_state(file, size, line_sep='\n', col_sep='\t', dec_pt='.', block_size=1 << 16):
+    # (offset, rows) as returned by read_spectrum_state for the first size bytes of a file,
+    # found by scanning back from the end - for data that were loaded from the cache
+    sep = record_separator(line_sep)
+    with open(file, 'rb') as f:
+        pos, tail = size, b''
+        while pos > 0:
+            start = max(pos - block_size, 0)
+            f.seek(start)
+            tail = f.read(pos - start) + tail
+            cut = tail.rfind(sep)
+            if cut >= 0:
+                tail = tail[cut + len(sep):]
+                break
+            pos = start
+    return size - len(tail), len(parse_block(tail.decode('latin-1'), line_sep, col_sep, dec_pt))
+
+
+def grow_buffer(buffer, used, needed):  # buffer with room for needed items along the last axis, doubling its capacity
+    if buffer.shape[-1] >= needed:
+        return buffer
+    grown = np.empty(buffer.shape[:-1] + (max(needed, 2 * buffer.shape[-1], 1024),), dtype=buffer.dtype)
+    grown[..., :used] = buffer[..., :used]
+    return grown
+
+
+def detect_peaks(ints, noise=0.0, min_prominence=0.0, min_width=0.0, min_distance=1):
+    # Whole-array peak search (plateaus are reported at their middle sample).
+    # Returns a structure of arrays: sample indexes, prominences and widths (in samples) of the peaks
+    from scipy.signal import find_peaks
+    idx, props = find_peaks(ints, height=noise, prominence=min_prominence, width=min_width,
+                            distance=max(1, int(min_distance)))
+    return {'index': idx.astype(np.int64), 'prominence': props['prominences'], 'width': props['widths']}
+
+
+def fit_components(fit_type, n_components=None, baseline=None):  # (number of components, constant baseline term)
+    n, with_baseline = FIT_TYPES[fit_type]
+    return (n if n_components is None else int(n_components)), bool(with_baseline if baseline is None else baseline)
+
+
+def window_scale(l_data):  # (middle, sample step) of a window: x = middle + step * u maps it to about [-m/2, m/2]
+    l_lo, l_hi = float(np.min(l_data)), float(np.max(l_data))
+    return (l_lo + l_hi) / 2, max((l_hi - l_lo) / max(len(l_data) - 1, 1), np.finfo(float).tiny)
+
+
+def scale_params(params, middle, step, errors=False):
+    # gaussian parameters on the axis u to the ones on x = middle + step * u (areas and widths scale with step,
+    # a constant baseline does not); errors=True for their standard errors, which are not shifted
+    params = np.array(params, dtype=np.float64)
+    n = params.size // 3
+    params[:3*n] *= step
+    if not errors:
+        params[1:3*n:3] += middle
+    return params
+
+
+def unscale_params(params, middle, step):  # the inverse of scale_params, infinite bounds stay infinite
+    params = np.array(params, dtype=np.float64)
+    n = params.size // 3
+    params[1:3*n:3] -= middle
+    params[:3*n] /= step
+    return params
+
+
+def initial_guess(l_data, i_data, n, with_baseline):
+    # Starting point taken from the data, in the units of l_data. Centres are at the strongest minima of the
+    # second derivative, where blended components still show up separately, and the widths come from
+    # height / curvature at them. The amplitudes (and delta) are then a linear least squares problem, solved
+    # on the window scaled to unit steps, as a gaussian of unit area on e.g. a Hz axis is ~1e-12 high
+    middle, scale = window_scale(l_data)
+    x, y = (np.asarray(l_data, dtype=np.float64) - middle) / scale, np.asarray(i_data, dtype=np.float64)
+    m = y.size
+    h = y - (min(y[0], y[-1]) if with_baseline else 0.0)
+    smooth = np.convolve(h, [0.25, 0.5, 0.25], mode='same') if m >= 5 else h
+    d2 = np.gradient(np.gradient(smooth)) if m >= 3 else np.zeros(m)  # per sample
+    if n == 1:
+        centres = [int(np.argmax(smooth))]
+    else:
+        inner = np.flatnonzero((d2[1:-1] < d2[:-2]) & (d2[1:-1] <= d2[2:]) & (d2[1:-1] < 0)) + 1
+        centres = inner[np.argsort(d2[inner])[:n]].tolist()
+        for i in np.argsort(smooth)[::-1].tolist():  # too few minima: the highest samples not taken yet
+            if len(centres) >= n:
+                break
+            if all(abs(i - c) > 1 for c in centres) or len(centres) + 1 > m // 3:
+                centres.append(i)
+        centres = sorted(centres[:n])
+    step = np.abs(np.gradient(x)) if m >= 2 else np.ones(m)
+    curvature = np.maximum(-d2[centres], 1e-12 * max(np.abs(h).max(), 1e-300))
+    widths = np.clip(np.sqrt(np.maximum(smooth[centres], 0) / curvature), 0.5, max(m / 4, 0.5)) * step[centres]
+    p0 = np.zeros(3*n + with_baseline)
+    p0[1:3*n:3], p0[2:3*n:3] = x[centres], widths
+    basis = np.empty((m, n + with_baseline))  # unit-area components, plus the constant term
+    for k in range(n):
+        basis[:, k] = multi_gauss(x, 1.0, x[centres[k]], widths[k])
+    if with_baseline:
+        basis[:, n] = 1.0
+    coefs = np.linalg.lstsq(basis, y, rcond=None)[0]
+    p0[0:3*n:3] = np.maximum(coefs[:n], 0)
+    if with_baseline:
+        p0[-1] = coefs[n]
+    return scale_params(p0, middle, scale)
+
+
+def fit_bounds(l_data, i_data, n, with_baseline, noise=0.0, bounded=False):
+    # starting point and bounds for n gaussian components; a single one is left free unless bounded is set
+    i_max = i_data.max()
+    l_lo, l_hi = min(l_data[0], l_data[-1]), max(l_data[0], l_data[-1])
+    span = max(l_hi - l_lo, np.finfo(float).tiny)
+    step = span / max(len(l_data) - 1, 1)
+    if n == 1 and not bounded:
+        lower, upper = [0, -np.inf, 0], [np.inf, np.inf, np.inf]
+    else:  # amplitudes are areas: from a component of the noise height and one sample wide,
+        # up to one of the maximal height and as wide as the window; widths from a tenth of a sample to the window
+        area = math.sqrt(2*math.pi)
+        lower = [max(min(noise, i_max), 0) * step * area, l_lo, step / 10]
+        upper = [max(i_max, np.finfo(float).tiny) * span * area, l_hi, span]
+    lower, upper = lower * n, upper * n
+    if with_baseline:
+        lower.append(-np.inf)
+        upper.append(np.inf)
+    p0 = np.clip(initial_guess(l_data, i_data, n, with_baseline), lower, upper)
+    return p0, (lower, upper)
+
+
+def fit_window(l_data, i_data, n, with_baseline, noise=0.0, cancel=None, p0=None):
+    # returns (parameters, their standard errors, convergence statistics); p0 - optional starting point, e.g.
+    # a neighbouring fit, cancel - optional callable, the fit is aborted with OperationCancelled once it returns True
+    calls = [0, 0]  # evaluations of the model and of its jacobian
+
+    def model(x, *params):
+        calls[0] += 1
+        if cancel is not None and cancel():
+            raise OperationCancelled()
+        return multi_gauss(x, *params)
+
+    def jac(x, *params):
+        calls[1] += 1
+        return multi_gauss_jac(x, *params)
+    default_p0, bounds = fit_bounds(l_data, i_data, n, with_baseline, noise)
+    warm = p0 is not None and len(p0) == len(default_p0)
+    if warm:  # a warm start may come from a slightly different window, so it is moved inside the current bounds
+        p0 = np.clip(p0, bounds[0], bounds[1])
+    else:
+        p0 = default_p0
+    from scipy.optimize import curve_fit
+    # the fit runs on the window scaled to unit steps: on a raw Hz axis the jacobian is ~1e-11 and the
+    # optimiser stops at once on its gradient test
+    middle, scale = window_scale(l_data)
+    u_data = (np.asarray(l_data, dtype=np.float64) - middle) / scale
+    u_bounds = (unscale_params(bounds[0], middle, scale), unscale_params(bounds[1], middle, scale))
+    u_p0 = np.clip(unscale_params(p0, middle, scale), u_bounds[0], u_bounds[1])
+    with profiler.stage('fit', points=len(l_data), components=n, warm=warm) as stage:
+        try:
+            params, pcov = curve_fit(model, u_data, i_data, p0=u_p0, bounds=u_bounds, jac=jac)
+        finally:
+            stage.set(nfev=calls[0], njev=calls[1])
+    errors = scale_params(np.sqrt(np.diag(pcov)), middle, scale, errors=True)
+    params = scale_params(params, middle, scale)
+    residual = float(np.sum((multi_gauss(l_data, *params) - i_data)**2))
+    stats = {'nfev': calls[0], 'njev': calls[1], 'residual': residual,
+             'reduced_chi2': residual / max(len(l_data) - len(params), 1), 'warm': warm}
+    return params, errors, stats
+
+
+def batch_multi_gauss(x, params):
+    # multi_gauss of a batch of parameter rows (batch, n_params) on x of shape (points,) or (batch, points);
+    # returns (values, jacobian): (batch, points) and (batch, points, n_params)
+    p = np.asarray(params, dtype=np.float64)
+    n = p.shape[1] // 3
+    x = np.asarray(x, dtype=np.float64)
+    x = x[:, np.newaxis, :] if x.ndim == 2 else x
+    amp, x_0, sigma = p[:, 0:3*n:3, np.newaxis], p[:, 1:3*n:3, np.newaxis], p[:, 2:3*n:3, np.newaxis]
+    with np.errstate(all='ignore'):  # rows that wander off give non-finite values, the callers reject them
+        z = (x - x_0) / sigma  # (batch, components, points)
+        g = np.exp(-z**2 / 2) / (sigma * math.sqrt(2*math.pi))
+        term = amp * g / sigma
+        jac = np.empty((p.shape[0], z.shape[2], p.shape[1]))
+        jac[:, :, 0:3*n:3] = g.transpose(0, 2, 1)
+        jac[:, :, 1:3*n:3] = (term * z).transpose(0, 2, 1)
+        jac[:, :, 2:3*n:3] = (term * (z**2 - 1)).transpose(0, 2, 1)
+        f = (amp * g).sum(axis=1)
+    if p.shape[1] % 3:
+        f = f + p[:, -1:]
+        jac[:, :, -1] = 1.0
+    return f, jac
+
+
+def batch_refit(l_data, samples, p0, lower, upper, ftol=1e-10, max_iter=100):
+    # Fits multi_gauss to every row of samples (batch, points) at once, all of them starting from p0: a
+    # Levenberg-Marquardt step is one batched solve of the small normal equations, scaled by their diagonal
+    # (so Hz-sized parameters are fine), with the parameters held at an active bound like in sparse_least_squares.
+    # l_data - shared axis (points,) or one per row; returns (parameters (batch, n_params), converged (batch,))
+    y = np.asarray(samples, dtype=np.float64)
+    lower, upper = np.asarray(lower, dtype=np.float64), np.asarray(upper, dtype=np.float64)
+    x = np.asarray(l_data, dtype=np.float64)
+    batch, n_params = y.shape[0], lower.size
+    p = np.tile(np.clip(np.asarray(p0, dtype=np.float64), lower, upper), (batch, 1))
+    f, jac = batch_multi_gauss(x, p)
+    r = f - y
+    cost = np.einsum('bi,bi->b', r, r)
+    lam = np.full(batch, 1e-3)
+    running, converged = np.ones(batch, dtype=bool), np.zeros(batch, dtype=bool)
+    eye = np.eye(n_params)
+    for _ in range(max_iter):
+        k = np.flatnonzero(running)
+        if k.size == 0:
+            break
+        xk = x[k] if x.ndim == 2 else x
+        j, pk = jac[k], p[k]
+        grad = np.einsum('bip,bi->bp', j, r[k])
+        normal = np.einsum('bip,biq->bpq', j, j)
+        d = np.sqrt(np.einsum('bpp->bp', normal))
+        d[d == 0] = 1.0
+        free = ~(((pk <= lower) & (grad > 0)) | ((pk >= upper) & (grad < 0)))
+        system = normal / (d[:, :, np.newaxis] * d[:, np.newaxis, :]) + lam[k, np.newaxis, np.newaxis] * eye
+        system = np.where(free[:, :, np.newaxis] & free[:, np.newaxis, :], system, eye)
+        rhs = np.where(free, -grad / d, 0.0)
+        with np.errstate(all='ignore'):
+            step = np.linalg.solve(system, rhs[:, :, np.newaxis])[:, :, 0] / d
+        trial = np.clip(pk + step, lower, upper)
+        trial[~np.all(np.isfinite(trial), axis=1)] = pk[~np.all(np.isfinite(trial), axis=1)]
+        f_trial, jac_trial = batch_multi_gauss(xk, trial)
+        r_trial = f_trial - y[k]
+        trial_cost = np.einsum('bi,bi->b', r_trial, r_trial)
+        better = trial_cost < cost[k]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            decrease = np.where(cost[k] > 0, (cost[k] - trial_cost) / cost[k], 0.0)
+        a = k[better]  # accepted steps
+        p[a], r[a], cost[a], jac[a] = trial[better], r_trial[better], trial_cost[better], jac_trial[better]
+        lam[a] = np.maximum(lam[a] / 10, 1e-12)
+        lam[k[~better]] *= 10
+        stop = k[(better & (decrease < ftol)) | (~better & (lam[k] > 1e12))]  # no step lowers the residual: a minimum
+        running[stop], converged[stop] = False, True
+    return p, converged
+
+
+def fit_uncertainty(l_data, i_data, n, with_baseline, params, noise=0.0, method='Residual bootstrap', n_samples=200,
+                    level=0.95, seed=None, max_workers=None, batch_size=256, cancel=None):
+    # Refits of resampled data around the fitted params: 'Residual bootstrap' adds the residuals drawn with
+    # replacement to the fitted curve, 'Pairs bootstrap' draws the (x, y) points themselves, 'Monte Carlo' adds
+    # gaussian noise of the residual spread. All refits start from params; batches of batch_size go to a process
+    # pool when there are several of them. Returns a dict with the standard deviations, the central confidence
+    # intervals at level and the correlation matrix of the parameters over the converged refits
+    x, y = np.asarray(l_data, dtype=np.float64), np.asarray(i_data, dtype=np.float64)
+    params = np.asarray(params, dtype=np.float64)
+    m = y.size
+    rng = np.random.default_rng(seed)
+    fitted = multi_gauss(x, *params)
+    residuals = y - fitted
+    dof = max(m - params.size, 1)
+    if method == 'Residual bootstrap':  # residuals are inflated by sqrt(m / dof), the fit has already shrunk them
+        xs, ys = x, fitted + residuals[rng.integers(0, m, (n_samples, m))] * math.sqrt(m / dof)
+    elif method == 'Pairs bootstrap':
+        pick = np.sort(rng.integers(0, m, (n_samples, m)), axis=1)
+        xs, ys = x[pick], y[pick]
+    elif method == 'Monte Carlo':
+        xs, ys = x, fitted + rng.normal(0.0, math.sqrt(float(residuals @ residuals) / dof), (n_samples, m))
+    else:
+        raise ValueError('unknown uncertainty method: ' + str(method))
+    lower, upper = fit_bounds(x, y, n, with_baseline, noise, bounded=True)[1]  # refits stay in the window
+    batches = [(xs if xs.ndim == 1 else xs[i:i + batch_size], ys[i:i + batch_size])
+               for i in range(0, n_samples, batch_size)]
+    results = []
+    with profiler.stage('uncertainty', points=m, samples=n_samples, method=method):
+        if max_workers == 1 or len(batches) <= 1:
+            for batch_x, batch_y in batches:
+                if cancel is not None and cancel():
+                    raise OperationCancelled()
+                results.append(batch_refit(batch_x, batch_y, params, lower, upper))
+        else:
+            executor = ProcessPoolExecutor(max_workers=max_workers)
+            futures = []
+            try:
+                futures = [executor.submit(batch_refit, batch_x, batch_y, params, lower, upper)
+                           for batch_x, batch_y in batches]
+                for future in futures:
+                    if cancel is not None and cancel():
+                        raise OperationCancelled()
+                    results.append(future.result())
+            finally:
+                shutdown_executor(executor, futures)
+    refits = np.concatenate([result[0] for result in results])
+    ok = np.concatenate([result[1] for result in results]) & np.all(np.isfinite(refits), axis=1)
+    good = refits[ok]
+    tail = (1 - level) / 2 * 100
+    if good.shape[0] > 1:
+        ci_lower, ci_upper = np.percentile(good, [tail, 100 - tail], axis=0)
+        std = good.std(axis=0, ddof=1)
+        with np.errstate(divide='ignore', invalid='ignore'):  # a parameter stuck at a bound has no spread
+            correlation = np.corrcoef(good, rowvar=False)
+    else:
+        ci_lower = ci_upper = std = np.full(params.size, np.nan)
+        correlation = np.full((params.size, params.size), np.nan)
+    return {'method': method, 'samples': n_samples, 'converged': int(ok.sum()), 'level': level, 'params': params,
+            'std': std, 'lower': ci_lower, 'upper': ci_upper, 'correlation': correlation, 'refits': good}
+
+
+def fit_stats_textout(stats):
+    if not stats:
+        return ''
+    return 'Function / jacobian evaluations: {} / {};<br>residual sum of squares = {:.4g}; ' \
+           'reduced \u03c7<sup>2</sup> = {:.4g}'.format(stats['nfev'], stats['njev'], stats['residual'],
+                                                      stats['reduced_chi2'])
+
+
+class FitCache:  # bounded LRU storage of fit results, keys start with the (begin, end) of the fitted window
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def nearest(self, key):  # the value whose window overlaps key's window most, the rest of the key must match
+        begin, end = key[0], key[1]
+        best, best_overlap = None, 0
+        for other, value in self.entries.items():
+            if other[2:] == key[2:]:
+                overlap = min(end, other[1]) - max(begin, other[0])
+                if overlap > best_overlap:
+                    best, best_overlap = value, overlap
+        return best
+
+    def clear(self):
+        self.entries.clear()
+
+
+class PeakIndex:
+    # Peaks sorted by their position on an axis: nearest peak, peaks in a range and the k highest peaks in a range
+    # in logarithmic time (plus the size of the answer). The highest peak of any range comes from a sparse table.
+    # Queries return peak numbers, i.e. indexes into pk_idx
+
+    def __init__(self, positions, heights):
+        positions, heights = np.asarray(positions, dtype=np.float64), np.asarray(heights, dtype=np.float64)
+        self.order = np.argsort(positions, kind='stable')
+        self.positions = positions[self.order]
+        self.heights = heights[self.order]
+        self.table = [np.arange(self.order.size)]  # table[j][i] - the highest of sorted peaks i ... i + 2^j - 1
+        j = 1
+        while (1 << j) <= self.order.size:
+            prev, half = self.table[-1], 1 << (j - 1)
+            a, b = prev[:self.order.size - (1 << j) + 1], prev[half:half + self.order.size - (1 << j) + 1]
+            self.table.append(np.where(self.heights[a] >= self.heights[b], a, b))
+            j += 1
+
+    def highest(self, lo, hi):  # position in the sorted order of the highest peak among lo ... hi - 1 (hi > lo)
+        j = (hi - lo).bit_length() - 1
+        a, b = self.table[j][lo], self.table[j][hi - (1 << j)]
+        return int(a if self.heights[a] >= self.heights[b] else b)
+
+    def bounds(self, x_lo, x_hi):  # [lo, hi) of the sorted peaks inside [x_lo, x_hi]
+        if x_lo > x_hi:
+            x_lo, x_hi = x_hi, x_lo
+        return int(np.searchsorted(self.positions, x_lo, 'left')), int(np.searchsorted(self.positions, x_hi, 'right'))
+
+    def nearest(self, x):  # -1 if there are no peaks
+        i = int(np.searchsorted(self.positions, x))
+        if self.order.size == 0:
+            return -1
+        if i == self.order.size or (i > 0 and x - self.positions[i - 1] <= self.positions[i] - x):
+            i -= 1
+        return int(self.order[i])
+
+    def in_range(self, x_lo, x_hi):  # peak numbers ordered by position, a view
+        lo, hi = self.bounds(x_lo, x_hi)
+        return self.order[lo:hi]
+
+    def top(self, x_lo, x_hi, k):  # up to k peak numbers in [x_lo, x_hi], the highest first
+        lo, hi = self.bounds(x_lo, x_hi)
+        found = []
+        heap = []
+        if hi > lo:
+            i = self.highest(lo, hi)
+            heap.append((-self.heights[i], i, lo, hi))
+        while heap and len(found) < k:  # every popped range is split around its highest peak
+            _, i, lo, hi = heapq.heappop(heap)
+            found.append(int(self.order[i]))
+            for sub_lo, sub_hi in ((lo, i), (i + 1, hi)):
+                if sub_hi > sub_lo:
+                    j = self.highest(sub_lo, sub_hi)
+                    heapq.heappush(heap, (-self.heights[j], j, sub_lo, sub_hi))
+        return np.asarray(found, dtype=np.int64)
+
+
+def fit_param_names(n, with_baseline):
+    names = [name + '_' + str(k) for k in range(1, n + 1) for name in ('A', 'x', 's')]
+    return names + ['delta'] if with_baseline else names
+
+
+def fit_table_dtype(n_params):  # one row per fitted peak, see DataHandler.fit_peaks
+    return np.dtype([('peak', np.int64), ('index', np.int64), ('begin', np.int64), ('end', np.int64),
+                     ('params', np.float64, (n_params,)), ('errors', np.float64, (n_params,)),
+                     ('success', np.bool_), ('message', 'U80'), ('nfev', np.int64), ('residual', np.float64)])
+
+
+def _fit_chunk(tasks, n, with_baseline, noise):  # runs in the worker processes of DataHandler.iter_fit_peaks
+    n_params = 3*n + with_baseline
+    results = []
+    for row, pk_num, index, begin, end, l_data, i_data in tasks:
+        try:
+            params, errors, stats = fit_window(l_data, i_data, n, with_baseline, noise)
+            success, message = bool(np.all(np.isfinite(errors))), ''
+        except (RuntimeError, ValueError, TypeError) as exc:  # not converged / too few points in the window
+            params, errors = np.full(n_params, np.nan), np.full(n_params, np.nan)
+            success, message, stats = False, str(exc)[:80], {'nfev': 0, 'residual': np.nan}
+        results.append((row, (pk_num, index, begin, end, params, errors, success, message,
+                              stats['nfev'], stats['residual'])))
+    return results
+
+
+def sparse_least_squares(residuals, jac, p0, lower, upper, ftol=1e-10, max_iter=200):
+    # Levenberg-Marquardt for a sparse jacobian: every step solves the sparse normal equations (J'J + lam D) dp = -J'r
+    # directly, D - the diagonal of J'J, so the parameters may have any scale (Hz...). Parameters at a bound
+    # the gradient pushes against are held there for the step, the others are clipped to the bounds.
+    # Returns (parameters, J'J at them, residual sum of squares, whether the relative decrease fell below ftol)
+    from scipy.sparse import diags
+    from scipy.sparse.linalg import spsolve
+    p = np.clip(np.asarray(p0, dtype=np.float64), lower, upper)
+    r = residuals(p)
+    cost = float(r @ r)
+    lam, decrease = 1e-3, np.inf
+    for _ in range(max_iter):
+        j = jac(p)
+        jtj, grad = (j.T @ j).tocsc(), j.T @ r
+        scale = jtj.diagonal()
+        scale[scale <= 0] = 1.0
+        free = ~(((p <= lower) & (grad > 0)) | ((p >= upper) & (grad < 0)))
+        system = jtj[free][:, free]
+        while True:
+            step = np.zeros_like(p)
+            step[free] = spsolve(system + diags(lam * scale[free]), -grad[free])
+            trial = np.clip(p + step, lower, upper)
+            r_trial = residuals(trial) if np.all(np.isfinite(trial)) else None
+            trial_cost = float(r_trial @ r_trial) if r_trial is not None else np.inf
+            if trial_cost < cost or lam > 1e12:
+                break
+            lam *= 10
+        if not trial_cost < cost:  # no step along the gradient lowers the residual: a minimum
+            return p, jtj, cost, True
+        decrease = (cost - trial_cost) / cost
+        p, r, cost = trial, r_trial, trial_cost
+        lam = max(lam / 10, 1e-12)
+        if decrease < ftol:
+            break
+    j = jac(p)
+    return p, j.T @ j, cost, decrease < ftol
+
+
+def global_fit_windows(pk_idx, vicinity, widths, size):  # [begins, ends) of the lines of fit_global
+    half = np.full(np.size(pk_idx), max(int(vicinity), 1))
+    if widths is not None:  # a window shorter than the line would let its tails leak into the baseline
+        half = np.maximum(half, np.ceil(2 * np.asarray(widths, dtype=np.float64)).astype(np.int64))
+    return np.maximum(pk_idx - half, 0), np.minimum(pk_idx + half + 1, size)
+
+
+def fit_global(l_data, i_data, pk_idx, vicinity, widths=None, knot_spacing=None, cancel=None):
+    # All peaks in one model: a gaussian at every index of pk_idx (ascending), evaluated in its own window of
+    # +-vicinity samples (at least two widths), on top of a shared piecewise linear baseline with knots every
+    # knot_spacing samples (by default two of the widest windows).
+    # A residual depends only on the lines whose windows cover it and on two knots, so the jacobian is kept
+    # sparse and so are the normal equations solved in sparse_least_squares: the cost grows with peaks * window size.
+    # widths - FWHM of the peaks in samples (as from detect_peaks) for the starting point;
+    # returns (params, errors, fitted curve, its baseline, stats), params = A_1, x_1, s_1, ..., A_n, x_n, s_n
+    from scipy.sparse import csr_matrix
+    x, y = np.asarray(l_data, dtype=np.float64), np.asarray(i_data, dtype=np.float64)
+    m = y.size
+    pk_idx = np.asarray(pk_idx, dtype=np.int64)
+    n = pk_idx.size
+    if m < 2 or n == 0:
+        raise ValueError('global fit needs peaks and at least two points')
+    begins, ends = global_fit_windows(pk_idx, vicinity, widths, m)
+    half = np.maximum(pk_idx - begins, ends - 1 - pk_idx)
+    lengths = ends - begins
+    owner = np.repeat(np.arange(n), lengths)  # (sample, line) pairs of the windows: the line...
+    rows = np.arange(lengths.sum()) + np.repeat(begins - (np.cumsum(lengths) - lengths), lengths)  # ...and the sample
+
+    spacing = max(int(knot_spacing or 2*(2*half.max() + 1)), 1)
+    knots = np.unique(np.append(np.arange(0, m, spacing), m - 1))
+    segment = np.clip(np.searchsorted(knots, np.arange(m), side='right') - 1, 0, knots.size - 2)
+    t = (np.arange(m) - knots[segment]) / (knots[segment + 1] - knots[segment])
+    basis = csr_matrix((np.concatenate((1 - t, t)), (np.tile(np.arange(m), 2), np.concatenate((segment, segment + 1)))),
+                       shape=(m, knots.size))  # baseline = basis @ knot values
+
+    n_params = 3*n + knots.size
+    jac_rows = np.concatenate((rows, rows, rows, np.tile(np.arange(m), 2)))
+    jac_cols = np.concatenate((3*owner, 3*owner + 1, 3*owner + 2, 3*n + np.concatenate((segment, segment + 1))))
+    pattern = csr_matrix((np.arange(1, jac_rows.size + 1, dtype=np.float64), (jac_rows, jac_cols)),
+                         shape=(m, n_params))
+    order = pattern.data.astype(np.int64) - 1  # csr position -> entry of the data computed below, the pattern is fixed
+    baseline_data = np.concatenate((1 - t, t))
+    calls = [0, 0]
+
+    def gaussians(p):
+        amp, x_0, sigma = p[0:3*n:3][owner], p[1:3*n:3][owner], p[2:3*n:3][owner]
+        z = (x[rows] - x_0) / sigma
+        g = np.exp(-z**2 / 2) / (sigma * math.sqrt(2*math.pi))
+        return amp, sigma, z, g
+
+    def residuals(p):
+        if cancel is not None and cancel():
+            raise OperationCancelled()
+        calls[0] += 1
+        amp, sigma, z, g = gaussians(p)
+        return np.bincount(rows, amp * g, minlength=m) + basis @ p[3*n:] - y
+
+    def jac(p):
+        calls[1] += 1
+        amp, sigma, z, g = gaussians(p)
+        term = amp * g / sigma
+        data = np.concatenate((g, term * z, term * (z**2 - 1), baseline_data))
+        return csr_matrix((data[order], pattern.indices, pattern.indptr), shape=(m, n_params))
+
+    # starting point: the detected positions and widths, the baseline follows the lower envelope of the data
+    lo, hi = np.minimum(x[begins], x[ends - 1]), np.maximum(x[begins], x[ends - 1])
+    step = (hi - lo) / np.maximum(lengths - 1, 1)
+    edges = np.concatenate(([0], (knots[1:] + knots[:-1]) // 2 + 1))
+    envelope = np.minimum.reduceat(y, edges)
+    sigma_0 = (2.0 if widths is None else np.asarray(widths, dtype=np.float64)) / (2*math.sqrt(2*math.log(2))) * step
+    lower = np.concatenate((np.column_stack((np.zeros(n), lo, step / 10)).ravel(), np.full(knots.size, -np.inf)))
+    upper = np.concatenate((np.column_stack((np.full(n, np.inf), hi, np.maximum((hi - lo) / 6, step / 5))).ravel(),
+                            np.full(knots.size, np.inf)))  # +-3 sigma stay inside the window
+    heights = np.maximum(y[pk_idx] - (basis @ envelope)[pk_idx], 0)
+    p0 = np.concatenate((np.column_stack((heights * sigma_0 * math.sqrt(2*math.pi), x[pk_idx], sigma_0)).ravel(),
+                         envelope))
+    p0 = np.clip(p0, lower, upper)
+
+    with profiler.stage('global fit', points=m, peaks=n, knots=knots.size) as stage:
+        try:
+            params, jtj, residual, converged = sparse_least_squares(residuals, jac, p0, lower, upper)
+        finally:
+            stage.set(nfev=calls[0], njev=calls[1])
+    dof = max(m - n_params, 1)
+
+    # The errors of a line come from the covariance of the parameters sharing samples with it: its own, those of
+    # the lines with overlapping windows and the knots under it. The complete covariance would be a dense inverse
+    jtj = jtj.tocsr()
+    errors = np.full(3*n, np.nan)
+    first = np.searchsorted(ends, begins, side='right')
+    last = np.searchsorted(begins, ends, side='left')
+    for k in range(n):
+        lines = np.arange(first[k], last[k])
+        cols = np.concatenate(((3*lines[:, np.newaxis] + np.arange(3)).ravel(),
+                               3*n + np.arange(segment[begins[k]], segment[ends[k] - 1] + 2)))
+        cov = np.linalg.pinv(jtj[cols][:, cols].toarray()) * (residual / dof)
+        own = 3*(k - first[k]) + np.arange(3)
+        errors[3*k:3*k + 3] = np.sqrt(np.abs(np.diag(cov)[own]))
+    stats = {'nfev': calls[0], 'njev': calls[1], 'residual': residual, 'reduced_chi2': residual / dof,
+             'warm': False, 'success': converged, 'knots': knots.size}
+    return params[:3*n], errors, residuals(params) + y, basis @ params[3*n:], stats
+
+
+LIGHT_SPEED = 2.9979e10  # cm/s
+UNIT_FACTORS = {'nm': (1.0, False), 'Hz': (LIGHT_SPEED * 1.0e7, True), 's^-1': (2 * np.pi * LIGHT_SPEED * 1.0e7, True)}
+# units -> (k, reciprocal): a value in these units is k*lambda[nm], or k/lambda[nm] for the reciprocal ones
+
+
+def convert_axis(values, from_units, to_units):  # always a single vectorized step, so nothing drifts
+    k_from, rec_from = UNIT_FACTORS[from_units]
+    k_to, rec_to = UNIT_FACTORS[to_units]
+    if rec_from == rec_to:
+        return values * (k_to / k_from)
+    return (k_from * k_to) / values
+
+
+def convert_fit_params(params, errors, from_units, to_units):
+    # centres are converted exactly; widths, areas and their errors are scaled by |d(new)/d(old)| at each centre,
+    # which is new/old for both the proportional and the reciprocal relations
+    if from_units == to_units or from_units == '' or to_units == '':
+        return params, errors
+    params, errors = np.array(params, dtype=float), np.array(errors, dtype=float)
+    n = params.size // 3
+    centres = params[1:3*n:3]
+    new_centres = convert_axis(centres, from_units, to_units)
+    scale = np.abs(new_centres / centres)
+    for k in (0, 2):
+        params[k:3*n:3] *= scale
+        errors[k:3*n:3] *= scale
+    params[1:3*n:3] = new_centres
+    errors[1:3*n:3] *= scale
+    return params, errors
+
+
 class DataHandler:
 
-    def __init__(self, file, noise_level, line_sep='\n', col_sep='\t', dec_pt='.'):  # noise level is in [0..1]
+    def __init__(self, file, noise_level, line_sep='\n', col_sep='\t', dec_pt='.', cache=None,
+                 min_prominence=0.0, min_width=0.0, min_distance=1, progress=None, header=None, read_workers=None):
+        # noise level and prominence are in [0..1], progress is passed to read_spectrum; separators and header
+        # lines given as None are sniffed from the file, read_workers - processes parsing a large file
         self.size = 0
-        self.lmds = []  # todo change everything to nympy-arrays for better performance
-        self.ints = []
+        self.raw_lmds = np.empty(0)  # the axis as imported, it is never modified
+        self.raw_units = ''
+        self.unit_axes = {}  # units -> read-only axis derived from raw_lmds
+        self.ints = np.empty(0)  # the intensities peaks and fits work on: raw_ints, or raw_ints - baseline
+        self.raw_ints = np.empty(0)  # as imported
+        self.baseline = None
+        self.baseline_settings = {}  # method and options it was estimated with
+        self.subtract_baseline = False
+        self.baseline_buffer = None  # storage of baseline and of the corrected ints, they grow in the watch mode
+        self.corrected_buffer = None
         self.pk_count = 0
-        self.peaks = []
+        self.pk_idx = np.empty(0, dtype=np.int64)  # peaks are parallel arrays, indexes are for internal navigation
+        self.pk_prominence = np.empty(0)
+        self.pk_width = np.empty(0)
+        self.pk_settings = {}
+        self.peaks_version = 0  # incremented whenever the peak arrays change
+        self.peak_index_cache = (None, None)  # (key, PeakIndex)
         self.fitting = [[], []]  # first array - lambdas, second - intensities
-        self.fit_params = {'Gaussian': [], 'Doublet(gaussian)': [], 'Triplet(gaussian)': [], 'Quadruplet(gaussian)': []}
+        self.fit_params = {fit_type: [] for fit_type in FIT_TYPES}
+        self.fit_errors = {fit_type: [] for fit_type in FIT_TYPES}
+        self.fit_units = {fit_type: '' for fit_type in FIT_TYPES}  # axis units the parameters were fitted in
+        self.fit_stats = {fit_type: {} for fit_type in FIT_TYPES}  # see fit_window
+        self.global_fit = None  # see DataHandler.fit_global
+        self.fit_uncertainties = {fit_type: None for fit_type in FIT_TYPES}  # see fit_uncertainty
         self.fit_func_render_pt_density = 5
+        self.fit_cache = FitCache()
+        self.data_version = 0  # to be incremented whenever ints change, it is part of the fit cache keys
+        self.deconvolver = Deconvolver()
         self.current_units = ''
+        self.cache = cache  # Cache.SpectrumCache or None
+        self.cache_key = None  # None once the data no longer match the file they were cached for
+        self.file = file
+        line_sep, col_sep, dec_pt, header = resolve_format(file, line_sep, col_sep, dec_pt, header)
+        self.read_settings = (line_sep, col_sep, dec_pt)
+        self.header_lines = header
+        self.read_workers = read_workers
+        self.bad_lines = []  # numbers of the lines skipped at import as not two numbers, cached too
+        self.read_offset = 0  # bytes of the file parsed as complete lines
+        self.read_size = 0  # bytes of the file seen so far
+        self.tail_rows = 0  # rows parsed from an unterminated last line, replaced once it is complete
+        self.buffer = None  # (2, capacity) storage of raw_lmds and ints, allocated when data are appended
+        self.axis_buffers = {}  # units -> storage of the derived axes, the same way
+        self.i_max = 0.0
+
+        with profiler.stage('import') as stage:
+            with profiler.stage('read') as read_stage:
+                cached = self.load(file, line_sep, col_sep, dec_pt, progress, header)
+                read_stage.set(points=self.size, bytes=self.read_size, cached=cached)
+            self.detect_peaks(noise_level, min_prominence, min_width, min_distance)
+            stage.set(points=self.size)
+
+    def load(self, file, line_sep, col_sep, dec_pt, progress=None, header=None):  # True if the data came from the cache
+        loaded = None
+        if self.cache is not None:
+            self.read_size = os.path.getsize(file)
+            self.cache_key = self.cache.key(file, line_sep, col_sep, dec_pt, header)
+            loaded = self.cache.load(self.cache_key)  # read-only memory maps, nothing is copied
+        if loaded is None:
+            self.bad_lines = []
+            self.raw_lmds, self.ints, self.read_offset, self.tail_rows = \
+                read_spectrum_state(file, line_sep, col_sep, dec_pt, progress, header=header,
+                                    max_workers=self.read_workers, bad_lines=self.bad_lines)
+            self.read_size = os.path.getsize(file)
+            if self.cache is not None:
+                self.cache.store(self.cache_key, self.raw_lmds, self.ints, self.bad_lines)
+            self.raw_lmds.flags.writeable = False
+        else:
+            self.raw_lmds, self.ints = loaded
+            self.bad_lines = self.cache.load_bad_lines(self.cache_key) or []
+            self.read_offset, self.tail_rows = line_end_state(file, self.read_size, line_sep, col_sep, dec_pt)
+        self.raw_ints = self.ints
+        self.size = self.raw_lmds.size
+        return loaded is not None
+
+    def detect_peaks(self, noise_level=None, min_prominence=None, min_width=None, min_distance=None):
+        # can be re-run with new thresholds at any time, omitted ones keep their previous values
+        settings = {'noise_level': 0.0, 'min_prominence': 0.0, 'min_width': 0.0, 'min_distance': 1}
+        settings.update(self.pk_settings)
+        for name, value in (('noise_level', noise_level), ('min_prominence', min_prominence),
+                            ('min_width', min_width), ('min_distance', min_distance)):
+            if value is not None:
+                settings[name] = value
+        settings['baseline'] = dict(self.baseline_settings) if self.subtract_baseline else None
+        self.pk_settings = settings
+        i_max = self.i_max = self.ints.max() if self.size else 0.0
+        self.noise = settings['noise_level'] * i_max
+
+        peaks = None
+        if self.cache is not None and self.cache_key is not None:
+            peaks = self.cache.load_peaks(self.cache_key, settings)
+        if peaks is None:
+            with profiler.stage('peaks', points=self.size) as stage:
+                peaks = detect_peaks(self.ints, self.noise, settings['min_prominence'] * i_max,
+                                     settings['min_width'], settings['min_distance'])
+                stage.set(peaks=peaks['index'].size)
+            if self.cache is not None and self.cache_key is not None:
+                self.cache.store_peaks(self.cache_key, settings, peaks)
+        self.pk_idx, self.pk_prominence, self.pk_width = peaks['index'], peaks['prominence'], peaks['width']
+        self.pk_count = self.pk_idx.size
+        self.peaks_version += 1
+        return self.pk_count
+
+    def read_appended(self, margin=None):
+        # Watch mode: parses only the lines appended to the file since the last read, into arrays that grow
+        # by doubling, and re-runs peak detection on the new region plus margin samples before it.
+        # Returns the number of new rows, -1 if the file was truncated or is gone (it has to be imported again)
+        try:
+            size = os.path.getsize(self.file)
+        except OSError:
+            return -1
+        if size < self.read_size:
+            return -1
+        if size == self.read_size:
+            return 0
+        line_sep, col_sep, dec_pt = self.read_settings
+        with open(self.file, 'rb') as f:
+            f.seek(self.read_offset)
+            rows, tail = read_lines(f, line_sep, col_sep, dec_pt)[:2]
+            end = f.tell()
+        self.read_size = end
+        if rows.shape[0] == 0:  # only a part of a line so far
+            return 0
+        self.read_offset = end - len(tail)
+        old = self.size - self.tail_rows  # the unterminated line read before is part of the new rows now
+        if self.tail_rows:
+            self.data_version += 1
+            self.tail_rows = 0
+        changed = self._append_rows(rows, old)
+        self._update_peaks(changed, margin)
+        return self.size - old
+
+    def _append_rows(self, rows, old):
+        new_size = old + rows.shape[0]
+        if self.buffer is None:  # the first append: the imported arrays (possibly memory maps) are copied once
+            self.buffer = np.empty((2, max(2 * new_size, 1024)))
+            self.buffer[0, :old] = self.raw_lmds[:old]
+            self.buffer[1, :old] = self.raw_ints[:old]
+        else:
+            self.buffer = grow_buffer(self.buffer, old, new_size)
+        self.buffer[:, old:new_size] = rows.T
+        for units in list(self.unit_axes):
+            buffer = self.axis_buffers.get(units)
+            if buffer is None:
+                buffer = np.empty(self.buffer.shape[1])
+                buffer[:old] = self.unit_axes[units][:old]
+            else:
+                buffer = grow_buffer(buffer, old, new_size)
+            with np.errstate(divide='ignore'):  # a zero wavelength appended is shown at infinity
+                buffer[old:new_size] = convert_axis(rows[:, 0], self.raw_units, units)
+            self.axis_buffers[units] = buffer
+            self.unit_axes[units] = buffer[:new_size]
+            self.unit_axes[units].flags.writeable = False
+        self.raw_lmds = self.buffer[0, :new_size]
+        self.raw_lmds.flags.writeable = False
+        self.raw_ints = self.ints = self.buffer[1, :new_size]
+        self.size = new_size
+        changed = old if self.baseline is None else self._extend_baseline(old)
+        self.i_max = max(self.i_max, self.ints[changed:].max())
+        self.cache_key = None  # the cached data and peaks are of the file as it was imported
+        return changed  # the first sample of ints that is new or has changed
+
+    def estimate_baseline(self, method='ALS', **options):  # options go to Baseline.estimate_baseline, e.g. width
+        with profiler.stage('baseline', points=self.size, method=method):
+            baseline = estimate_baseline(self.raw_ints, method, **options)
+        return self.set_baseline(baseline, method, **options)
+
+    def set_baseline(self, baseline, method='ALS', **options):
+        # a baseline of raw_ints estimated elsewhere (e.g. on a worker thread), with the settings it was made with
+        if baseline.size != self.size:
+            raise ValueError('the baseline has {} points, the spectrum {}'.format(baseline.size, self.size))
+        self.baseline_buffer = baseline
+        self.baseline = self.baseline_buffer[:self.size]
+        self.baseline_settings = dict(options, method=method)
+        if self.subtract_baseline:
+            self._apply_baseline()
+        return self.baseline
+
+    def set_baseline_subtraction(self, subtract):  # peaks and fits use raw_ints - baseline while it is on
+        subtract = bool(subtract) and self.baseline is not None
+        if subtract != self.subtract_baseline:
+            self.subtract_baseline = subtract
+            self._apply_baseline()
+        return self.subtract_baseline
+
+    def _apply_baseline(self):
+        if self.subtract_baseline:
+            self.corrected_buffer = self.raw_ints - self.baseline
+            self.ints = self.corrected_buffer[:self.size]
+        else:
+            self.ints = self.raw_ints
+        self.data_version += 1
+        self.detect_peaks()
+
+    def _extend_baseline(self, old):
+        # watch mode: the baseline is estimated again over the new rows and 8 widths before them,
+        # the old one is kept up to 4 widths before; returns the first sample of ints that changed
+        options = {name: value for name, value in self.baseline_settings.items() if name != 'method'}
+        width = int(options.get('width', 100))
+        start = max(old - 8 * width, 0)
+        keep = max(old - 4 * width, start) if start > 0 else 0
+        fresh = estimate_baseline(self.raw_ints[start:], self.baseline_settings['method'], **options)
+        self.baseline_buffer = grow_buffer(self.baseline_buffer, keep, self.size)
+        self.baseline_buffer[keep:self.size] = fresh[keep - start:]
+        self.baseline = self.baseline_buffer[:self.size]
+        if not self.subtract_baseline:
+            return old
+        self.corrected_buffer = grow_buffer(self.corrected_buffer, keep, self.size)
+        self.corrected_buffer[keep:self.size] = self.raw_ints[keep:] - self.baseline[keep:]
+        self.ints = self.corrected_buffer[:self.size]
+        if keep < old:
+            self.data_version += 1
+        return keep
+
+    def _update_peaks(self, old, margin=None):
+        # Peaks found before start + margin/2 are kept, the rest are replaced by the ones found in ints[start:].
+        # Prominences and widths are not local, so with these filters on, or once a higher running maximum raises
+        # the height threshold, the peaks are detected again over the whole array. Otherwise only the new peaks and
+        # the kept ones whose prominence search reached the old end are measured again, on the whole array
+        settings = self.pk_settings
+        noise = settings['noise_level'] * self.i_max
+        if settings['min_prominence'] > 0 or settings['min_width'] > 0 or noise != self.noise:
+            self.detect_peaks()
+            return
+        from scipy.signal import find_peaks, peak_prominences, peak_widths
+        if margin is None:
+            margin = max(64, 4 * int(settings['min_distance']))
+        start = max(old - margin, 0)
+        boundary = start + margin // 2 if start > 0 else 0
+        found = find_peaks(self.ints[start:], height=noise, distance=max(1, int(settings['min_distance'])))[0]
+        found = found[found + start >= boundary] + start
+        keep = self.pk_idx < boundary
+        kept = self.pk_idx[keep]
+        prominence, width = self.pk_prominence[keep].copy(), self.pk_width[keep].copy()
+        if kept.size:  # no higher sample between a kept peak and the old end: its bases may lie in the new data
+            right_max = np.maximum.accumulate(np.maximum.reduceat(self.ints[:old], kept + 1)[::-1])[::-1]
+            stale = np.flatnonzero(self.ints[kept] >= right_max)
+        else:
+            stale = np.empty(0, dtype=np.int64)
+        measured = np.concatenate((kept[stale], found))
+        bases = peak_prominences(self.ints, measured)
+        widths = peak_widths(self.ints, measured, rel_height=0.5, prominence_data=bases)[0]
+        prominence[stale], width[stale] = bases[0][:stale.size], widths[:stale.size]
+        self.pk_idx = np.concatenate((kept, found)).astype(np.int64)
+        self.pk_prominence = np.concatenate((prominence, bases[0][stale.size:]))
+        self.pk_width = np.concatenate((width, widths[stale.size:]))
+        self.pk_count = self.pk_idx.size
+        self.peaks_version += 1
+
+    @property
+    def pk_lmds(self):  # peak positions on the current axis
+        return self.lmds[self.pk_idx]
 
-        f = open(file, 'r')
-        lines = f.read().split(line_sep)
-        self.size = len(lines)-1
-        for i in range(self.size):
-            lne = lines[i].replace(dec_pt, '.')
-            self.lmds.append(float(lne.split(col_sep)[0]))
-            self.ints.append(float(lne.split(col_sep)[1]))
-        f.close()
-        self.noise = noise_level * max(self.ints)
-        # print(max(self.ints))
-        for i in range(1, self.size-1):
-            if abs(self.ints[i]) > self.noise:
-                if (self.ints[i] - self.ints[i-1] > 0) and (self.ints[i+1] - self.ints[i] < 0):
-                    self.pk_count += 1
-                    self.peaks.append([i, self.lmds[i], self.ints[i]])  # indexes for peaks are for internal navigation
+    @property
+    def pk_ints(self):
+        return self.ints[self.pk_idx]
+
+    def peak_index(self):  # PeakIndex over the current axis, built again only after the peaks, data or units change
+        key = (self.current_units, self.peaks_version, self.data_version)
+        if self.peak_index_cache[0] != key:
+            self.peak_index_cache = (key, PeakIndex(self.pk_lmds, self.pk_ints))
+        return self.peak_index_cache[1]
 
     def pk_prox(self, pk_num, n):  # pk_num - number of the peak, <= pk_count; N - half of the points around a peak
-        return ([self.lmds[i] for i in range(self.peaks[pk_num][0] - n, self.peaks[pk_num][0] + n+1)],
-                [self.ints[i] for i in range(self.peaks[pk_num][0] - n, self.peaks[pk_num][0] + n+1)])
+        begin, end = self.pk_window(pk_num, n)
+        return self.lmds[begin:end], self.ints[begin:end]  # views, nothing is copied
 
-    def fit(self, begin, end, fit_type='Gaussian'):
-        l_data = np.asarray([self.lmds[i] for i in range(begin, end)])
-        i_data = np.asarray([self.ints[i] for i in range(begin, end)])
+    def fit(self, begin, end, fit_type='Gaussian', n_components=None, baseline=None, cancel=None):
+        units = self.current_units  # read once: the units may be changed from the GUI thread while this runs
+        l_data = self.axis(units)[begin:end]
+        i_data = self.ints[begin:end]
         Rs = []
         fitted_func = np.asarray([])
         if fit_type == 'None':
             pass
-        elif fit_type == 'Gaussian':
-            self.fit_params['Gaussian'], Rs = curve_fit(gauss, l_data, i_data,
-                                                        p0=[max(i_data), l_data[(end-begin)//2], 1, i_data[0]],
-                                                        bounds=([0, -np.inf, 0, -np.inf], [np.inf, np.inf, np.inf, np.inf]))
-            Rs = np.sqrt(np.diag(Rs))
-            fitted_func = gauss(np.linspace(l_data[0], l_data[-1], (end-begin)*self.fit_func_render_pt_density),
-                                *self.fit_params['Gaussian'])
-        elif fit_type == 'Doublet(gaussian)':
-            self.fit_params['Doublet(gaussian)'], Rs = curve_fit(doublet_gauss, l_data, i_data,
-                                                                 p0=[max(i_data), l_data[(end - begin) // 2], 1,
-                                                                     max(i_data), l_data[(end - begin) // 2], 1],
-                                                                 bounds=([self.noise, l_data[0], 0,
-                                                                          self.noise, l_data[0], 0],
-                                                                         [max(i_data), l_data[-1], np.inf,
-                                                                          max(i_data), l_data[-1], np.inf]))
-            Rs = np.sqrt(np.diag(Rs))
-            fitted_func = doublet_gauss(np.linspace(l_data[0], l_data[-1], (end-begin)*self.fit_func_render_pt_density),
-                                        *self.fit_params['Doublet(gaussian)'])
-        elif fit_type == 'Triplet(gaussian)':
-            self.fit_params['Triplet(gaussian)'], Rs = curve_fit(triplet_gauss, l_data, i_data,
-                                                        p0=[max(i_data), l_data[(end - begin) // 2], 1,
-                                                            max(i_data), l_data[(end - begin) // 2], 1,
-                                                            max(i_data), l_data[(end - begin) // 2], 1],
-                                                        bounds=([self.noise, l_data[0], 0,
-                                                                 self.noise, l_data[0], 0,
-                                                                 self.noise, l_data[0], 0],
-                                                                [max(i_data), l_data[-1], np.inf,
-                                                                 max(i_data), l_data[-1], np.inf,
-                                                                 max(i_data), l_data[-1], np.inf]))
-            Rs = np.sqrt(np.diag(Rs))
-            fitted_func = triplet_gauss(np.linspace(l_data[0], l_data[-1], (end-begin)*self.fit_func_render_pt_density),
-                                        *self.fit_params['Triplet(gaussian)'])
-        elif fit_type == 'Quadruplet(gaussian)':
-            self.fit_params['Quadruplet(gaussian)'], Rs = curve_fit(quadruplet_gauss, l_data, i_data,
-                                                                 p0=[max(i_data), l_data[(end - begin) // 2], 1,
-                                                                     max(i_data), l_data[(end - begin) // 2], 1,
-                                                                     max(i_data), l_data[(end - begin) // 2], 1,
-                                                                     max(i_data), l_data[(end - begin) // 2], 1],
-                                                                 bounds=([self.noise, l_data[0], 0,
-                                                                          self.noise, l_data[0], 0,
-                                                                          self.noise, l_data[0], 0,
-                                                                          self.noise, l_data[0], 0],
-                                                                         [max(i_data), l_data[-1], np.inf,
-                                                                          max(i_data), l_data[-1], np.inf,
-                                                                          max(i_data), l_data[-1], np.inf,
-                                                                          max(i_data), l_data[-1], np.inf]))
-            Rs = np.sqrt(np.diag(Rs))
-            fitted_func = quadruplet_gauss(np.linspace(l_data[0], l_data[-1], (end-begin)*self.fit_func_render_pt_density),
-                                           *self.fit_params['Quadruplet(gaussian)'])
+        else:
+            n, with_baseline = fit_components(fit_type, n_components, baseline)
+            # the noise threshold sets the amplitude bounds of multiplets, so it is part of the key as well
+            key = (begin, end, fit_type, n, with_baseline, units, self.data_version, self.noise)
+            cached = self.fit_cache.get(key)
+            if cached is None:
+                warm = self.fit_cache.nearest(key)  # e.g. the same peak with a slightly different vicinity
+                cached = fit_window(l_data, i_data, n, with_baseline, self.noise, cancel,
+                                    p0=None if warm is None else warm[0])
+                self.fit_cache.put(key, cached)
+            self.fit_params[fit_type], Rs, self.fit_stats[fit_type] = cached
+            self.fit_errors[fit_type], self.fit_units[fit_type] = Rs, units
+            fitted_func = multi_gauss(np.linspace(l_data[0], l_data[-1], (end-begin)*self.fit_func_render_pt_density),
+                                      *self.fit_params[fit_type])
         return Rs, fitted_func
 
-    def get_conv_func(self, begin, end, fit_type='Gaussian'):
-        l_data = np.asarray([self.lmds[i] for i in range(begin, end)])
-        i_data = np.asarray([self.ints[i] for i in range(begin, end)])
+    def fit_uncertainty(self, begin, end, fit_type='Gaussian', n_components=None, baseline=None,
+                        method='Residual bootstrap', n_samples=200, level=0.95, seed=None, max_workers=None, cancel=None):
+        # resampling uncertainties of the fit of [begin, end), see fit_uncertainty above; the point estimate is
+        # fitted first (usually it is already in the fit cache), the result is kept in self.fit_uncertainties
+        units = self.current_units
+        self.fit(begin, end, fit_type, n_components, baseline, cancel)
+        n, with_baseline = fit_components(fit_type, n_components, baseline)
+        params = convert_fit_params(np.asarray(self.fit_params[fit_type]), np.asarray(self.fit_errors[fit_type]),
+                                    self.fit_units[fit_type], units)[0]  # the units may have changed during fit
+        result = fit_uncertainty(self.axis(units)[begin:end], self.ints[begin:end], n, with_baseline,
+                                 params, self.noise, method, n_samples, level, seed, max_workers, cancel=cancel)
+        result['units'] = units
+        self.fit_uncertainties[fit_type] = result
+        return result
+
+    def pk_window(self, pk_num, n):  # [begin, end) of the vicinity of a peak, clipped to the data
+        i = int(self.pk_idx[pk_num])
+        return max(i - n, 0), min(i + n + 1, self.size)
+
+    def iter_fit_peaks(self, vicinity, fit_type='Gaussian', pk_nums=None, n_components=None, baseline=None,
+                       max_workers=None, chunk_size=16):
+        # Fits every peak (or the chosen ones) in its own vicinity window across a process pool.
+        # Yields (row, record) in completion order: row is the position in pk_nums, record matches fit_table_dtype
+        n, with_baseline = fit_components(fit_type, n_components, baseline)
+        pk_nums = np.arange(self.pk_count) if pk_nums is None else np.asarray(pk_nums, dtype=np.int64)
+        tasks = []
+        for row, pk_num in enumerate(pk_nums.tolist()):
+            begin, end = self.pk_window(pk_num, vicinity)
+            tasks.append((row, pk_num, int(self.pk_idx[pk_num]), begin, end,
+                          np.array(self.lmds[begin:end]), np.array(self.ints[begin:end])))
+        chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+        if max_workers == 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                yield from _fit_chunk(chunk, n, with_baseline, self.noise)
+            return
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+        futures = []
+        try:
+            futures = [executor.submit(_fit_chunk, chunk, n, with_baseline, self.noise) for chunk in chunks]
+            for future in as_completed(futures):
+                yield from future.result()
+        finally:  # also reached when the consumer stops iterating early
+            shutdown_executor(executor, futures)
+
+    def fit_peaks(self, vicinity, fit_type='Gaussian', pk_nums=None, n_components=None, baseline=None,
+                  max_workers=None, callback=None):  # callback(row, record) is called as results come in
+        n, with_baseline = fit_components(fit_type, n_components, baseline)
+        count = self.pk_count if pk_nums is None else len(pk_nums)
+        table = np.zeros(count, dtype=fit_table_dtype(3*n + with_baseline))
+        for row, record in self.iter_fit_peaks(vicinity, fit_type, pk_nums, n_components, baseline, max_workers):
+            table[row] = record
+            if callback is not None:
+                callback(row, record)
+        return table
+
+    def fit_global(self, vicinity, knot_spacing=None, cancel=None):
+        # every detected peak and a shared baseline in one fit, see fit_global above; returns the fit_peaks table
+        # (one gaussian per peak, the residual is that of its window) and keeps the curves in self.global_fit
+        units = self.current_units  # read once, as in fit
+        params, errors, fitted, baseline, stats = fit_global(self.axis(units), self.ints, self.pk_idx, vicinity,
+                                                             self.pk_width, knot_spacing, cancel)
+        begins, ends = global_fit_windows(self.pk_idx, vicinity, self.pk_width, self.size)
+        squares = np.concatenate(([0.0], np.cumsum((fitted - self.ints)**2)))
+        table = np.zeros(self.pk_count, dtype=fit_table_dtype(3))
+        table['peak'] = np.arange(self.pk_count)
+        table['index'], table['begin'], table['end'] = self.pk_idx, begins, ends
+        table['params'], table['errors'] = params.reshape(-1, 3), errors.reshape(-1, 3)
+        table['success'] = stats['success'] & np.all(np.isfinite(table['errors']), axis=1)
+        table['message'] = '' if stats['success'] else 'not converged'
+        table['nfev'] = stats['nfev']
+        table['residual'] = squares[ends] - squares[begins]
+        self.global_fit = {'table': table, 'fitted': fitted, 'baseline': baseline, 'stats': stats,
+                           'units': units, 'data_version': self.data_version}
+        return table
+
+    def get_conv_func(self, begin, end, fit_type='Gaussian', method='Wiener', **options):
+        # estimate of the hardware function: the data deconvolved by the fitted spectrum,
+        # zero lag is in the middle of the window; options go to Deconvolver.deconvolve
+        l_data = self.lmds[begin:end]
+        i_data = self.ints[begin:end]
         hw_func = np.asarray([])
-        if fit_type == 'None':
+        if fit_type == 'None' or len(self.fit_params.get(fit_type, [])) == 0:
             pass
-        elif fit_type == 'Gaussian':
-            fitted_func = gauss(l_data, *self.fit_params['Gaussian'])
-            fourier_data = fft(i_data)
-            fourier_func = fft(fitted_func)
-            hw_func = np.asarray(ifft(np.divide(fourier_data, fourier_func)), float)
         else:
-            pass
+            params = self.fit_result(fit_type)[0]
+            key = (begin, end, self.current_units, self.data_version, fit_type, params.tobytes())
+            with profiler.stage('deconvolution', points=end - begin, method=method):
+                hw_func = self.deconvolver.deconvolve(i_data, lambda: multi_gauss(l_data, *params), method, key,
+                                                      **options)
         return hw_func
 
+    @property
+    def lmds(self):  # the axis in the current units, derived from the immutable raw axis once per unit
+        return self.axis(self.current_units)
+
+    def axis(self, units):
+        if units == self.raw_units or units == '':
+            return self.raw_lmds
+        if units not in self.unit_axes:
+            with profiler.stage('units', points=self.size, units=units), np.errstate(divide='raise'):
+                converted = convert_axis(self.raw_lmds, self.raw_units, units)
+            converted.flags.writeable = False
+            self.unit_axes[units] = converted
+        return self.unit_axes[units]
+
     def change_units(self, new_units):
-        c = 2.9979e10
-        if self.current_units == '':
-            self.current_units = new_units
+        if self.current_units == '':  # the first units given are the ones of the imported data
+            self.raw_units = self.current_units = new_units
             return True
+        elif new_units not in UNIT_FACTORS or self.raw_units not in UNIT_FACTORS:
+            return False
         else:
             try:
-                if self.current_units == 'nm' and new_units == 'Hz':
-                    self.lmds = [c/(L*1.0e-7) for L in self.lmds]
-                elif self.current_units == 'Hz' and new_units == 'nm':
-                    self.lmds = [c / L * 1.0e7 for L in self.lmds]
-                elif self.current_units == 'nm' and new_units == 's^-1':
-                    self.lmds = [2 * np.pi * c / (L * 1.0e-7) for L in self.lmds]
-                elif self.current_units == 's^-1' and new_units == 'nm':
-                    self.lmds = [(2*np.pi*c / L)*1.0e7  for L in self.lmds]
-                elif self.current_units == 's^-1' and new_units == 'Hz':
-                    self.lmds = [L/(2*np.pi) for L in self.lmds]
-                elif self.current_units == 'Hz' and new_units == 's^-1':
-                    self.lmds = [L * 2*np.pi for L in self.lmds]
+                self.axis(new_units)
                 self.current_units = new_units
-                for i in range(self.pk_count):
-                    self.peaks[i][1] = self.lmds[self.peaks[i][0]]
                 return True
-            except ZeroDivisionError:
+            except FloatingPointError:  # numpy reports division by zero this way inside errstate
                 return False
 
+    def fit_result(self, fit_type):  # (parameters, errors) of the last fit of fit_type, in the current units
+        params, errors = np.asarray(self.fit_params[fit_type]), np.asarray(self.fit_errors[fit_type])
+        if params.size == 0:
+            return params, errors
+        return convert_fit_params(params, errors, self.fit_units[fit_type], self.current_units)
+
+
 def main():
+    from matplotlib import pyplot as plt  # imported here, so the GUI can still choose its backend after Spectra
     PK_NUM = 27
     daaa = DataHandler('shots/He_test3.txt', 0.02)
     draw_lambda, draw_i = daaa.pk_prox(PK_NUM, 50)
 
     fig, (ax_lin, ax_log) = plt.subplots(1, 2)
-    fig.suptitle('Spectrum around lambda = ' + str(daaa.peaks[PK_NUM][1]))
+    fig.suptitle('Spectrum around lambda = ' + str(daaa.pk_lmds[PK_NUM]))
     ax_log.set_yscale('log')
     ax_lin.plot(draw_lambda, draw_i)
     ax_log.plot(draw_lambda, list(map(abs, draw_i)))
@@ -0,0 +1,60 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Batch  # noqa: E402
+from Dataset import SpectrumSet  # noqa: E402
+from Spectra import DataHandler, multi_gauss  # noqa: E402
+
+
+def shot(x, centre, height=1.0):
+    return multi_gauss(x, height * 2 * np.sqrt(2 * np.pi), centre, 2.0) + 0.1
+
+
+def test_resampled_shots_track_and_normalize():
+    axis = np.linspace(600.0, 700.0, 1001)
+    dataset = SpectrumSet(axis, 'nm')
+    dataset.add(axis, shot(axis, 650.0))
+    other = np.linspace(620.0, 720.0, 777)  # another grid, starting inside the shared one
+    dataset.add(other, shot(other, 652.5, 3.0))
+    assert dataset.resampled == 1
+    assert np.isnan(dataset.data[1, 0]) and np.isfinite(dataset.data[1, -1])
+    positions, heights = dataset.track_peak(640.0, 660.0)
+    np.testing.assert_allclose(positions, [650.0, 652.5], atol=0.01)
+    np.testing.assert_allclose(heights, [1.1, 3.1], rtol=1e-3)
+    dataset.normalize('max')
+    np.testing.assert_allclose(np.nanmax(dataset.data, axis=1), 1.0)
+    assert np.all(np.isnan(dataset.track_peak(400.0, 500.0)[0]))
+
+
+def write_shot(path, x, y):
+    with open(path, 'w') as f:
+        f.write(''.join('{:.6f}\t{:.6f}\n'.format(a, b) for a, b in zip(x, y)))
+
+
+def test_from_handlers_uses_the_units_of_the_first(tmp_path):
+    axis = np.linspace(600.0, 700.0, 1001)
+    handlers = []
+    for k, centre in enumerate((650.0, 655.0)):
+        write_shot(tmp_path / 'shot{}.txt'.format(k), axis, shot(axis, centre))
+        handler = DataHandler(str(tmp_path / 'shot{}.txt'.format(k)), 0.05)
+        handler.change_units('nm')
+        handlers.append(handler)
+    handlers[1].change_units('Hz')  # shown in other units, the data are the same
+    dataset = SpectrumSet.from_handlers(handlers)
+    assert dataset.resampled == 0
+    np.testing.assert_allclose(dataset.track_peak(640.0, 660.0)[0], [650.0, 655.0], atol=0.01)
+
+
+def test_batch_track(tmp_path):
+    axis = np.linspace(600.0, 700.0, 1001)
+    for k, centre in enumerate((648.0, 650.0, 652.0)):
+        write_shot(tmp_path / 'shot{}.txt'.format(k), axis, shot(axis, centre, 1.0 + k))
+    output = tmp_path / 'line.npy'
+    assert Batch.main([str(tmp_path / 'shot*.txt'), '--track', '640', '660', '--normalize', 'max',
+                       '-o', str(output)]) == 0
+    table = np.load(output)
+    np.testing.assert_allclose(table['position'], [648.0, 650.0, 652.0], atol=0.01)
+    np.testing.assert_allclose(table['height'], 1.0, rtol=1e-3)
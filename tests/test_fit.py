@@ -0,0 +1,20 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Spectra import convert_axis, convert_fit_params, fit_window, multi_gauss  # noqa: E402
+
+
+def test_fit_converges_in_every_unit():
+    rng = np.random.default_rng(1)
+    lmds = np.linspace(545.0, 555.0, 201)
+    ints = multi_gauss(lmds, 2.0, 550.3, 0.8, 0.1) + 0.01 * rng.standard_normal(lmds.size)
+    params_nm, _, stats_nm = fit_window(lmds, ints, 1, True)
+    for units in ('Hz', 's^-1'):
+        params, errors, stats = fit_window(convert_axis(lmds, 'nm', units), ints, 1, True)
+        assert stats['nfev'] > 1
+        assert abs(stats['residual'] - stats_nm['residual']) < 0.05 * stats_nm['residual']
+        centre = convert_fit_params(params, errors, units, 'nm')[0][1]
+        assert abs(centre - params_nm[1]) < 0.01  # a fifth of a sample: the axes are not linear in each other
@@ -0,0 +1,63 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Spectra import parse_block, read_spectrum, read_spectrum_state  # noqa: E402
+
+
+def test_parse_block_two_columns():
+    for col_sep in (' ', '\t'):
+        text = '1{0}2\n3{0}4\n'.format(col_sep)
+        bad = []
+        rows = parse_block(text, col_sep=col_sep, bad_lines=bad)
+        np.testing.assert_array_equal(rows, [[1, 2], [3, 4]])
+        assert bad == []
+
+
+def test_parse_block_uneven_lines_are_not_regrouped():
+    # the total number of fields is even, but the lines are not pairs: "4" must be reported, not joined with "3"
+    for col_sep in (' ', '\t'):
+        text = '1{0}2{0}3\n4\n5{0}6\n'.format(col_sep)
+        bad = []
+        rows = parse_block(text, col_sep=col_sep, bad_lines=bad)
+        np.testing.assert_array_equal(rows, [[1, 2], [5, 6]])
+        assert bad == [1]
+
+
+def test_read_spectrum_sniffs_header(tmp_path):
+    path = tmp_path / 'export.txt'
+    path.write_text('Spectrum\nWavelength;Intensity\nnm;counts\n' +
+                    ''.join('{};{}\n'.format(400 + k, k).replace('.', ',') for k in range(100)))
+    bad = []
+    lmds, ints = read_spectrum_state(str(path), None, None, None, bad_lines=bad)[:2]
+    np.testing.assert_array_equal(lmds, 400 + np.arange(100))
+    assert bad == []
+    np.testing.assert_array_equal(read_spectrum(str(path), None, None, None)[1], np.arange(100))
+
+
+def test_read_spectrum_semicolon_crlf(tmp_path):
+    path = tmp_path / 'export.txt'
+    rows = ''.join('{}\t{},5;\r\n'.format(400 + k, k) for k in range(1000))
+    path.write_bytes(('Spectrum;\r\n' + rows + '1400\t1000,5;').encode('latin-1'))
+    bad = []
+    lmds, ints, offset, tail_rows = read_spectrum_state(str(path), None, None, None, block_size=4096, bad_lines=bad)
+    np.testing.assert_array_equal(lmds, 400 + np.arange(1001))
+    np.testing.assert_array_equal(ints, np.arange(1001) + 0.5)
+    assert bad == []
+    assert offset == path.stat().st_size - len('1400\t1000,5;') and tail_rows == 1
+
+
+def test_cache_keeps_header_and_bad_lines(tmp_path):
+    from Cache import SpectrumCache
+    from Spectra import DataHandler
+    path = tmp_path / 'export.txt'
+    path.write_text('Wavelength\tIntensity\n' + ''.join('{}\t{}\n'.format(400 + k, k) for k in range(50)) +
+                    'broken\n' + ''.join('{}\t{}\n'.format(450 + k, k) for k in range(50)))
+    cache = SpectrumCache(str(tmp_path / 'cache'))
+    first = DataHandler(str(path), 0.01, cache=cache)
+    cached = DataHandler(str(path), 0.01, cache=cache)
+    assert first.bad_lines == cached.bad_lines == [52]
+    assert cached.size == first.size == 100
+    assert DataHandler(str(path), 0.01, cache=cache, header=2).size == 99  # not the entry of the sniffed header
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Spectra import DataHandler  # noqa: E402
+
+
+def write_rows(f, x, y):
+    f.write(''.join('{:.6f}\t{:.6f}\n'.format(a, b) for a, b in zip(x, y)))
+    f.flush()
+
+
+def appended_matches_full(tmp_path, **settings):
+    rng = np.random.default_rng(0)
+    x = np.linspace(400, 700, 20000)
+    y = np.exp(-(x - 450)**2 / 2) + np.exp(-(x - 650)**2 / 8) * 3 + rng.random(x.size) * 0.2
+    path = tmp_path / 'spectrum.txt'
+    with open(path, 'w') as f:
+        write_rows(f, x[:1000], y[:1000])
+        watched = DataHandler(str(path), 0.01, '\n', '\t', '.', header=0, read_workers=1, **settings)
+        for begin in range(1000, x.size, 1000):
+            write_rows(f, x[begin:begin + 1000], y[begin:begin + 1000])
+            watched.read_appended()
+    full = DataHandler(str(path), 0.01, '\n', '\t', '.', header=0, read_workers=1, **settings)
+    np.testing.assert_array_equal(watched.pk_idx, full.pk_idx)
+    np.testing.assert_allclose(watched.pk_prominence, full.pk_prominence)
+    np.testing.assert_allclose(watched.pk_width, full.pk_width)
+
+
+def test_appended_peaks_match_full_detection(tmp_path):
+    appended_matches_full(tmp_path)
+
+
+def test_appended_peaks_match_full_detection_with_filters(tmp_path):
+    appended_matches_full(tmp_path, min_prominence=0.02)
+    appended_matches_full(tmp_path, min_width=3)
+
+
+def test_appended_rows_of_semicolon_crlf_file(tmp_path):
+    path = tmp_path / 'spectrum.txt'
+    line = lambda k: '{}\t{},5;\r\n'.format(400 + k, k % 7).encode('latin-1')
+    with open(path, 'wb') as f:
+        f.write(b'Spectrum;\r\n' + b''.join(line(k) for k in range(1000)))
+        f.flush()
+        watched = DataHandler(str(path), 0.01, read_workers=1)
+        assert watched.read_settings[0] == ';\n' and watched.size == 1000
+        f.write(b''.join(line(k) for k in range(1000, 1005)))
+        f.flush()
+        assert watched.read_appended() == 5
+    np.testing.assert_array_equal(watched.raw_lmds, 400 + np.arange(1005))